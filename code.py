@@ -1,45 +1,2365 @@
+import functools
+import gzip
+import itertools
 import logging
+import multiprocessing
 import json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from telegram.error import TelegramError
+import re
+import os
+import secrets
+import signal
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+import asyncio
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dotenv import load_dotenv
+from sortedcontainers import SortedList
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent, Message
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, ContextTypes, InlineQueryHandler, MessageHandler, TypeHandler, filters
+from telegram.error import TelegramError, RetryAfter, NetworkError, Forbidden
+from telegram.request import BaseRequest, HTTPXRequest
 
 # Configuration
+# Settings read through os.environ can be overridden from the environment or a .env file.
+load_dotenv()
 ADMIN_IDS = [6293126201, 5460768109, 5220416927]
-BOT_TOKEN = "8024871818:AAESCglln2EI_T7tGV-7vaxpJafjz8Jhd0"
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "8024871818:AAESCglln2EI_T7tGV-7vaxpJafjz8Jhd0")
+BOT_API_URL = os.environ.get("BOT_API_URL", "https://api.telegram.org/bot")  # a local stub for load tests
+BOT_MODE = os.environ.get("BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # public base URL Telegram delivers updates to
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # random per start if unset
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443"))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))  # parallel deliveries from Telegram, 1-100
+CONNECTION_POOL_SIZE = int(os.environ.get("CONNECTION_POOL_SIZE", "64"))  # Bot API connections, at least CONCURRENT_UPDATES
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1024"))  # queued updates before intake waits
+SHARDS = int(os.environ.get("SHARDS", "1"))  # worker processes; more than one needs STORAGE_BACKEND=sqlite
+SHARD_STOP_TIMEOUT = 30  # seconds a worker gets to flush and exit on shutdown
+METRICS_ENABLED = os.environ.get("METRICS", "") == "1"  # handler, storage and Bot API timings
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # HTTP endpoint for scrapers; 0 disables it
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")  # "json" (snapshot + log) or "sqlite"
 DATA_FILE = "match_data.json"
+SQLITE_FILE = "match_data.sqlite3"
+WAL_FILE = "match_data.wal"
+ARCHIVE_FILE = "match_archive.sqlite3"  # finished matches moved out of memory by /archive
+ARCHIVE_CACHE_SIZE = 1000  # users' and matches' archived entries kept in memory
+ARCHIVE_MMAP_BYTES = 256 * 1024 * 1024  # how much of the archive file reads map into memory
+ARCHIVE_ATTEMPTS = 3  # tries to archive a match whose points keep changing meanwhile
+COMPACT_EVERY = 5000  # log records between snapshot compactions
+FLUSH_INTERVAL_MS = 250  # longest a change waits before it is written
+FLUSH_MAX_PENDING = 500  # dirty paths that force an immediate flush
+STATS_TOP = 5  # players listed per ranking in /stats
+RANKINGS_TOP = 20  # users listed by /rankings
+SETTLE_RULE = os.environ.get("SETTLE_RULE", "winner")  # default pool rule of /settle, one of POOL_RULES
+SETTLE_COMMISSION = float(os.environ.get("SETTLE_COMMISSION", "0"))  # share of each pool kept back, 0 to 1
+SETTLE_TOP = 10  # payouts listed by /settle; more come as a CSV file
+SCORECARD_MAX_BYTES = 256 * 1024
+BACKUP_FORMAT = "satta-backup/1"
+RESTORE_MAX_BYTES = 20 * 1024 * 1024  # largest file a bot may download from Telegram
+SEND_RATE = 25  # messages per second, under Telegram's ~30/s bot-wide limit
+PER_CHAT_INTERVAL = 1.0  # seconds between messages to the same chat
+SEND_RETRIES = 3
+BROADCAST_WORKERS = 8
+BROADCAST_PROGRESS_EVERY = 15  # seconds between progress updates to the admin
+PAGE_CHARS = 3500  # page size, well under Telegram's 4096-character message limit
+KEYBOARD_PAGE_SIZE = 20  # buttons per inline keyboard page
+INLINE_RESULTS = 20  # players per page of inline search results, at most 50
+RENDER_CACHE_SIZE = 10000  # rendered /profile and /check pages kept
+SCREEN_CACHE_SIZE = 10000  # edited messages whose content is remembered, to skip edits that change nothing
+SAVINGS_REPORT_EVERY = 60  # seconds between log lines on the Bot API calls skipped
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))  # updates processed at the same time
+LOCK_SHARDS = 256  # locks per kind (users, matches) shared out by key hash
+DUPLICATE_TAP_WINDOW = float(os.environ.get("DUPLICATE_TAP_WINDOW", "1.0"))  # seconds a repeated identical button tap is ignored; 0 disables
+USER_RATE = float(os.environ.get("USER_RATE", "2"))  # messages and taps per second a user may keep up; 0 disables
+USER_BURST = 8  # messages and taps a user may send at once before USER_RATE applies
+MATCH_TIMEZONE = timezone(timedelta(hours=5, minutes=30))  # start times without an offset are IST
+SCORE_LINE = re.compile(r'^(.+?)\s*[,;:\t ]\s*"?(-?\d+)"?$')
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# === METRICS ===
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Series are keyed by (name, sorted label pairs). Histogram buckets are stored
+    per bucket and only made cumulative when rendered, so observe() is a bisect
+    and two increments.
+    """
+
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, metric, value, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        series = self.histograms.get(key)
+        if series is None:
+            series = self.histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+        series[0][bisect_left(self.BUCKETS, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def gauge(self, metric, read):
+        """Report `read()` as gauge `metric` at render time."""
+        self.gauges[metric] = read
+
+    def render(self):
+        def labels(pairs, *extra):
+            pairs = pairs + extra
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+        lines, typed = [], set()
+        for (name, pairs), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{labels(pairs)} {value}")
+        for (name, pairs), (buckets, total, count) in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS + ("+Inf",), buckets):
+                cumulative += n
+                lines.append(f"{name}_bucket{labels(pairs, ('le', bound))} {cumulative}")
+            lines.append(f"{name}_sum{labels(pairs)} {total:.6f}")
+            lines.append(f"{name}_count{labels(pairs)} {count}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed(kind, name=None):
+    """Time calls into histogram bot_<kind>_seconds{name=...} and count exceptions.
+
+    Returns the function unchanged unless METRICS_ENABLED, so disabled timing
+    costs nothing.
+    """
+    def decorate(func):
+        if not METRICS_ENABLED:
+            return func
+        label = name or func.__name__
+        histogram, errors = f"bot_{kind}_seconds", f"bot_{kind}_errors_total"
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    metrics.inc(errors, name=label)
+                    raise
+                finally:
+                    metrics.observe(histogram, time.perf_counter() - started, name=label)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    metrics.inc(errors, name=label)
+                    raise
+                finally:
+                    metrics.observe(histogram, time.perf_counter() - started, name=label)
+        return wrapper
+    return decorate
+
+class MeasuredRequest(BaseRequest):
+    """Bot API request wrapper recording call latency and errors per API method."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(url, method, request_data, **timeouts)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_api_request_seconds", time.perf_counter() - started, method=api_method)
+        if code >= 300:
+            metrics.inc("bot_api_errors_total", method=api_method, error=str(code))
+        return code, payload
+
+async def serve_metrics(reader, writer):
+    """Answer any HTTP request on the metrics port with the current metrics."""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
 # Load or initialize database
-try:
-    with open(DATA_FILE, "r") as f:
-        db = json.load(f)
-except FileNotFoundError:
-    db = {
-        "matches": {},
-        "user_teams": {},
-        "points": {},
-        "amounts": {}
-    }
+def empty_db():
+    """Return a fresh, empty database layout."""
+    return {"matches": {}, "user_teams": {}, "points": {}, "amounts": {}}
+
+def apply_record(target, record):
+    """Apply a single logged mutation to a database dict."""
+    op, path = record[0], record[1]
+    if not path:
+        target.clear()
+        target.update(record[2] if op == "set" else empty_db())
+        return
+    node = target
+    for key in path[:-1]:
+        if op == "del":
+            node = node.get(key)
+            if not isinstance(node, dict):
+                return
+        else:
+            node = node.setdefault(key, {})
+    if op == "set":
+        node[path[-1]] = record[2]
+    else:
+        node.pop(path[-1], None)
+
+class Store(ABC):
+    """Storage backend interface.
+
+    `load()` rebuilds the database dict and `append()` receives batches of
+    ["set"/"del", path, value] records in order. When `needs_compaction()` says
+    so, `compact()` folds them into a snapshot. `close()` persists everything on
+    shutdown. Both take a frozen, encoded copy of the database from
+    snapshot_db(). `encode`/`decode` convert between the in-memory layout and
+    the stored one.
+    """
+
+    def __init__(self, encode=None, decode=None):
+        self.encode = encode or (lambda state: state)
+        self.decode = decode or (lambda data: False)
+
+    @abstractmethod
+    def load(self):
+        """Return the stored database dict."""
+
+    @abstractmethod
+    def append(self, records):
+        """Persist `records`; returns the bytes written, or None if the backend can't tell."""
+
+    def needs_compaction(self):
+        return False
+
+    def compact(self, snapshot):
+        """Fold the records written so far into `snapshot`, if the backend keeps one."""
+
+    @abstractmethod
+    def close(self, snapshot):
+        """Persist `snapshot` and release the backend."""
+
+class WriteAheadStore(Store):
+    """JSON snapshot plus an append-only log of mutation records.
+
+    Every change is appended to the log as one small JSON line, so the cost of a
+    write does not depend on the size of the database. On startup the snapshot is
+    loaded and the log replayed on top of it. Once the log grows past
+    `compact_every` records, the current state is written to a new snapshot in a
+    background thread and swapped in with an atomic rename.
+    """
+
+    def __init__(self, snapshot_path, log_path, compact_every=COMPACT_EVERY, encode=None, decode=None):
+        super().__init__(encode, decode)
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.rotated_path = log_path + ".1"
+        self.compact_every = compact_every
+        self.records = 0
+        self.log_end = 0  # byte offset just past the last readable record in the log
+        self._log = None
+        self._compactor = None
+
+    def load(self):
+        """Rebuild the database from the snapshot and any pending log records."""
+        data, replayed = self.read()
+        migrated = self.decode(data)
+        if migrated or os.path.exists(self.rotated_path) or replayed >= self.compact_every:
+            self._write_snapshot(json.dumps(self.encode(data)))
+            open(self.log_path, "w").close()
+            replayed = 0
+        elif os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.log_end:
+            # Cut off a torn tail, or new records would be appended after it and never replayed.
+            logger.warning(f"Truncating {self.log_path} to its last complete record")
+            os.truncate(self.log_path, self.log_end)
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        self.log_end = self._log.tell()
+        self.records = replayed
+        return data
+
+    def read(self):
+        """Return the stored data and the number of log records replayed, without touching the files."""
+        try:
+            with open(self.snapshot_path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        for key, value in empty_db().items():
+            data.setdefault(key, value)
+        # Records are "set"/"del" of a path, so replaying a rotated log that the
+        # snapshot already contains is harmless.
+        rotated, _ = self._replay(self.rotated_path, data)
+        replayed, self.log_end = self._replay(self.log_path, data)
+        return data, rotated + replayed
+
+    def _replay(self, path, data):
+        """Apply the records in `path`; returns how many, and the byte offset just past the last one."""
+        count = end = 0
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("record has no line end")
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash mid-append leaves a torn last line; nothing after it was acknowledged.
+                        logger.warning(f"Skipping unreadable record in {path}")
+                        break
+                    apply_record(data, record)
+                    count += 1
+                    end += len(line)
+        except FileNotFoundError:
+            pass
+        return count, end
+
+    def append(self, records):
+        """Append mutation records to the log."""
+        data = "".join(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+        try:
+            self._log.write(data)
+            self._log.flush()
+        except Exception:
+            # Cut off whatever part of the batch reached the file, or replay would stop there.
+            try:
+                self._log.close()
+            except OSError:
+                pass
+            os.truncate(self.log_path, self.log_end)
+            self._log = open(self.log_path, "a", encoding="utf-8")
+            raise
+        self.log_end = self._log.tell()
+        self.records += len(records)
+        return len(data)
+
+    def needs_compaction(self):
+        return self.records >= self.compact_every and not (self._compactor and self._compactor.is_alive())
+
+    def compact(self, snapshot):
+        """Start a new log and write `snapshot` out in a background thread."""
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        snapshot = json.dumps(snapshot)
+        self._rotate()
+        self._compactor = threading.Thread(target=self._compact_worker, args=(snapshot,), daemon=True)
+        self._compactor.start()
+
+    def _rotate(self):
+        self._log.close()
+        if os.path.exists(self.log_path):
+            os.replace(self.log_path, self.rotated_path)
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        self.log_end = 0
+        self.records = 0
+
+    def _write_snapshot(self, snapshot):
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+
+    def _compact_worker(self, snapshot):
+        try:
+            self._write_snapshot(snapshot)
+        except Exception as e:
+            logger.error(f"Failed to compact database: {e}")
+
+    def close(self, snapshot):
+        """Write a final snapshot and close the log."""
+        if self._compactor is not None:
+            self._compactor.join()
+        self._rotate()
+        self._compact_worker(json.dumps(snapshot))
+        self._log.close()
+
+class SqliteStore(Store):
+    """SQLite database in WAL mode with one table per kind of data.
+
+    It is the durable copy of the in-memory database, not something handlers
+    query: load() reads every table back at startup, and /profile, /check and
+    /target read the dict like every other handler. Records are translated into
+    row updates and each flushed batch is one transaction, so a batch is applied
+    all-or-nothing and the cost of a write depends only on the rows it touches.
+    Each write finds its rows by primary key, so the tables carry no secondary
+    indexes. Insertion order, which the rankings use to break ties, is kept by
+    updating rows in place. Top-level keys without
+    a table of their own are stored as JSON in `extra`. On first start the
+    existing JSON snapshot and log are imported.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS matches (name TEXT PRIMARY KEY, info TEXT NOT NULL DEFAULT '{}');
+        CREATE TABLE IF NOT EXISTS teams (match TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (match, name));
+        -- team '' holds the match-wide player list
+        CREATE TABLE IF NOT EXISTS players (
+            match TEXT NOT NULL, team TEXT NOT NULL, position INTEGER NOT NULL, name TEXT NOT NULL,
+            PRIMARY KEY (match, team, position)
+        );
+        CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS user_teams (
+            user_id TEXT NOT NULL, match TEXT NOT NULL, players TEXT NOT NULL, PRIMARY KEY (user_id, match)
+        );
+        CREATE TABLE IF NOT EXISTS points (player TEXT PRIMARY KEY, points INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS amounts (
+            user_id TEXT NOT NULL, match TEXT NOT NULL, amount INTEGER NOT NULL, PRIMARY KEY (user_id, match)
+        );
+        CREATE TABLE IF NOT EXISTS registry (kind TEXT NOT NULL, id INTEGER NOT NULL, name TEXT NOT NULL, PRIMARY KEY (kind, id));
+        CREATE TABLE IF NOT EXISTS extra (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        -- secondary indexes of earlier versions; nothing queried them
+        DROP INDEX IF EXISTS players_by_name;
+        DROP INDEX IF EXISTS user_teams_by_match;
+        DROP INDEX IF EXISTS amounts_by_match;
+    """
+    TABLES = ("matches", "teams", "players", "users", "user_teams", "points", "amounts", "registry", "extra")
+
+    def __init__(self, path, legacy=None, encode=None, decode=None):
+        super().__init__(encode, decode)
+        self.path = path
+        self.legacy = legacy
+        self.conn = None
+
+    def load(self):
+        """Read every table back into the database dict, importing the JSON files on first start."""
+        # Writes come from the persistence worker thread, one at a time.
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # Shard workers of a sharded deployment write to the same file.
+        self.conn.execute("PRAGMA busy_timeout=10000")
+        self.conn.executescript(self.SCHEMA)
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'initialized'").fetchone() is None:
+            with self.conn:
+                if self.legacy is not None:
+                    data, _ = self.legacy.read()
+                    self._put(self.conn, [], data)
+                    logger.info(f"Imported {self.legacy.snapshot_path} into {self.path}")
+                self.conn.execute("INSERT INTO meta VALUES ('initialized', '1')")
+        data = self._read()
+        if self.decode(data):
+            with self.conn:
+                self._put(self.conn, [], self.encode(data))
+        return data
+
+    def _read(self):
+        conn = self.conn
+        data = empty_db()
+        matches = data["matches"]
+        for name, info in conn.execute("SELECT name, info FROM matches ORDER BY rowid"):
+            matches[name] = {"teams": {}, "players": [], **json.loads(info)}
+        for match, name in conn.execute("SELECT match, name FROM teams ORDER BY rowid"):
+            matches[match]["teams"][name] = []
+        for match, team, name in conn.execute("SELECT match, team, name FROM players ORDER BY match, team, position"):
+            (matches[match]["players"] if team == "" else matches[match]["teams"][team]).append(name)
+        for (user_id,) in conn.execute("SELECT user_id FROM users ORDER BY rowid"):
+            data["user_teams"][user_id] = {}
+        for user_id, match, players in conn.execute("SELECT user_id, match, players FROM user_teams ORDER BY rowid"):
+            data["user_teams"].setdefault(user_id, {})[match] = json.loads(players)
+        data["points"] = dict(conn.execute("SELECT player, points FROM points ORDER BY rowid"))
+        for user_id, match, amount in conn.execute("SELECT user_id, match, amount FROM amounts ORDER BY rowid"):
+            data["amounts"].setdefault(user_id, {})[match] = amount
+        registry = {}
+        for kind, name in conn.execute("SELECT kind, name FROM registry ORDER BY kind, id"):
+            registry.setdefault(kind, []).append(name)
+        if registry:
+            data["registry"] = registry
+        for key, value in conn.execute("SELECT key, value FROM extra"):
+            data[key] = json.loads(value)
+        return data
+
+    def append(self, records):
+        """Apply a batch of records in one transaction."""
+        with self.conn:
+            for record in records:
+                self._put(self.conn, record[1], record[2] if record[0] == "set" else None)
+
+    def _put(self, conn, path, value):
+        """Store `value` at `path`, or delete it when `value` is None."""
+        if not path:
+            for table in self.TABLES:
+                conn.execute(f"DELETE FROM {table}")
+            for key, sub in (value or {}).items():
+                self._put(conn, [key], sub)
+            return
+        put = {
+            "matches": self._put_matches,
+            "user_teams": self._put_user_teams,
+            "points": self._put_points,
+            "amounts": self._put_amounts,
+            "registry": self._put_registry,
+        }.get(path[0])
+        if put is None:
+            self._put_extra(conn, path, value)
+        else:
+            put(conn, path[1:], value)
+
+    def _put_matches(self, conn, path, value):
+        if not path:
+            for table in ("matches", "teams", "players"):
+                conn.execute(f"DELETE FROM {table}")
+            for match, doc in (value or {}).items():
+                self._put_matches(conn, [match], doc)
+            return
+        match = path[0]
+        if len(path) == 1:
+            conn.execute("DELETE FROM teams WHERE match = ?", (match,))
+            conn.execute("DELETE FROM players WHERE match = ?", (match,))
+            if value is None:
+                conn.execute("DELETE FROM matches WHERE name = ?", (match,))
+                return
+            info = {k: v for k, v in value.items() if k not in ("teams", "players")}
+            conn.execute(
+                "INSERT INTO matches (name, info) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET info = excluded.info",
+                (match, json.dumps(info)),
+            )
+            for team, players in value.get("teams", {}).items():
+                self._put_roster(conn, match, team, players)
+            self._put_roster(conn, match, "", value.get("players", []))
+        elif path[1] == "teams" and len(path) == 3:
+            self._put_roster(conn, match, path[2], value)
+        elif path[1] == "teams":
+            conn.execute("DELETE FROM teams WHERE match = ?", (match,))
+            conn.execute("DELETE FROM players WHERE match = ? AND team != ''", (match,))
+            for team, players in (value or {}).items():
+                self._put_roster(conn, match, team, players)
+        elif path[1] == "players":
+            self._put_roster(conn, match, "", value)
+        else:
+            row = conn.execute("SELECT info FROM matches WHERE name = ?", (match,)).fetchone()
+            info = json.loads(row[0]) if row else {}
+            apply_record(info, ["del", path[1:]] if value is None else ["set", path[1:], value])
+            conn.execute("UPDATE matches SET info = ? WHERE name = ?", (json.dumps(info), match))
+
+    def _put_roster(self, conn, match, team, players):
+        conn.execute("DELETE FROM players WHERE match = ? AND team = ?", (match, team))
+        if team:
+            if players is None:
+                conn.execute("DELETE FROM teams WHERE match = ? AND name = ?", (match, team))
+                return
+            conn.execute("INSERT OR IGNORE INTO teams (match, name) VALUES (?, ?)", (match, team))
+        conn.executemany(
+            "INSERT INTO players (match, team, position, name) VALUES (?, ?, ?, ?)",
+            [(match, team, i, name) for i, name in enumerate(players or ())],
+        )
+
+    def _put_user_teams(self, conn, path, value):
+        if not path:
+            conn.execute("DELETE FROM users")
+            conn.execute("DELETE FROM user_teams")
+            for user_id, teams in (value or {}).items():
+                self._put_user_teams(conn, [user_id], teams)
+            return
+        user_id = path[0]
+        if len(path) == 1:
+            conn.execute("DELETE FROM user_teams WHERE user_id = ?", (user_id,))
+            if value is None:
+                conn.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+                return
+            conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+            for match, players in value.items():
+                self._put_user_teams(conn, [user_id, match], players)
+        elif value is None:
+            conn.execute("DELETE FROM user_teams WHERE user_id = ? AND match = ?", (user_id, path[1]))
+        else:
+            conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+            conn.execute(
+                "INSERT INTO user_teams (user_id, match, players) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, match) DO UPDATE SET players = excluded.players",
+                (user_id, path[1], json.dumps(value, separators=(",", ":"))),
+            )
+
+    def _put_points(self, conn, path, value):
+        if not path:
+            conn.execute("DELETE FROM points")
+            conn.executemany("INSERT INTO points (player, points) VALUES (?, ?)", (value or {}).items())
+        elif value is None:
+            conn.execute("DELETE FROM points WHERE player = ?", (path[0],))
+        else:
+            conn.execute(
+                "INSERT INTO points (player, points) VALUES (?, ?) "
+                "ON CONFLICT (player) DO UPDATE SET points = excluded.points",
+                (path[0], value),
+            )
+
+    def _put_amounts(self, conn, path, value):
+        if not path:
+            conn.execute("DELETE FROM amounts")
+            for user_id, bets in (value or {}).items():
+                self._put_amounts(conn, [user_id], bets)
+        elif len(path) == 1:
+            conn.execute("DELETE FROM amounts WHERE user_id = ?", (path[0],))
+            conn.executemany(
+                "INSERT INTO amounts (user_id, match, amount) VALUES (?, ?, ?)",
+                [(path[0], match, amount) for match, amount in (value or {}).items()],
+            )
+        elif value is None:
+            conn.execute("DELETE FROM amounts WHERE user_id = ? AND match = ?", (path[0], path[1]))
+        else:
+            conn.execute(
+                "INSERT INTO amounts (user_id, match, amount) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, match) DO UPDATE SET amount = excluded.amount",
+                (path[0], path[1], value),
+            )
+
+    def _put_registry(self, conn, path, value):
+        if not path:
+            conn.execute("DELETE FROM registry")
+            for kind, names in (value or {}).items():
+                self._put_registry(conn, [kind], names)
+            return
+        conn.execute("DELETE FROM registry WHERE kind = ?", (path[0],))
+        conn.executemany(
+            "INSERT INTO registry (kind, id, name) VALUES (?, ?, ?)",
+            [(path[0], i, name) for i, name in enumerate(value or ())],
+        )
+
+    def _put_extra(self, conn, path, value):
+        row = conn.execute("SELECT value FROM extra WHERE key = ?", (path[0],)).fetchone()
+        current = {path[0]: json.loads(row[0])} if row else {}
+        apply_record(current, ["del", path] if value is None else ["set", path, value])
+        if path[0] in current:
+            conn.execute(
+                "INSERT INTO extra (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (path[0], json.dumps(current[path[0]])),
+            )
+        else:
+            conn.execute("DELETE FROM extra WHERE key = ?", (path[0],))
+
+    def close(self, snapshot):
+        """Checkpoint the write-ahead log into the main database file and close it."""
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.close()
+
+def resolve_record(path):
+    """Build the log record that stores the current value at `path`."""
+    node = db
+    for key in path:
+        node = node.get(key) if isinstance(node, dict) else None
+        if node is None:
+            return ["del", list(path)]
+    if not path:
+        # A full copy: the flush thread serializes it while handlers keep changing db.
+        node = snapshot_db()
+    elif path[0] == "user_teams":
+        node = encode_teams(node, len(path))
+    else:
+        node = freeze(node)
+    return ["set", list(path), node]
+
+def freeze(value):
+    """Copy the dicts and lists of a JSON-like value; strings and numbers are shared."""
+    if isinstance(value, dict):
+        return {key: freeze(sub) for key, sub in value.items()}
+    if isinstance(value, list):
+        return [freeze(sub) for sub in value] if value and isinstance(value[0], (dict, list)) else list(value)
+    return value
+
+def snapshot_db():
+    """Consistent, encoded copy of the database that another thread can serialize.
+
+    Must be called on the event loop thread, where every mutation happens, so no
+    handler can be half-way through a change. Copying containers costs far less
+    than serializing them, which is left to the storage thread.
+    """
+    return {key: encode_teams(value) if key == "user_teams" else freeze(value) for key, value in db.items()}
+
+class PersistenceScheduler:
+    """Coalesces database mutations and flushes them to the store off the event loop.
+
+    `mark()` only records which path changed. A flush is scheduled at most every
+    `interval_ms`, or immediately once `max_pending` paths are dirty; repeated
+    changes to the same path are written once with their latest value. Encoding
+    and disk I/O run on a single worker thread so records stay in order.
+    """
+
+    def __init__(self, store, interval_ms=FLUSH_INTERVAL_MS, max_pending=FLUSH_MAX_PENDING):
+        self.store = store
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self.dirty = {}
+        self.mutations = 0
+        self.stats = {
+            "flushes": 0,
+            "mutations": 0,
+            "records": 0,
+            "max_coalesced": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-flush")
+        self._lock = None
+        self._timer = None
+
+    def mark(self, path):
+        """Record that the value at `path` changed and schedule a flush."""
+        self.dirty.pop(path, None)
+        self.dirty[path] = None
+        self.mutations += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Outside the bot's event loop (scripts, migrations) just write through.
+            batch = self._drain()
+            if not self._write(batch):
+                self._restore(batch)
+            return
+        if len(self.dirty) >= self.max_pending:
+            self._cancel_timer()
+            loop.create_task(self.flush())
+        else:
+            self._schedule(loop)
+
+    def _schedule(self, loop):
+        if self._timer is None:
+            self._timer = loop.call_later(self.interval, lambda: loop.create_task(self.flush()))
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _drain(self):
+        # Values are resolved on the loop thread; a path changed after this point
+        # is marked dirty again and picked up by the next flush.
+        paths = list(self.dirty)
+        records = [resolve_record(path) for path in paths]
+        mutations, self.mutations = self.mutations, 0
+        self.dirty = {}
+        return paths, records, mutations
+
+    def _restore(self, batch):
+        """Mark the paths of a batch that failed to write dirty again, so the next flush retries them."""
+        paths, _, mutations = batch
+        # Each record holds the value at flush time, so writing the latest values in any order is the same.
+        self.dirty = {**dict.fromkeys(paths), **self.dirty}
+        self.mutations += mutations
+
+    def _write(self, batch):
+        """Append a drained batch to the store; returns False if that failed."""
+        _, records, mutations = batch
+        if not records:
+            return True
+        started = time.perf_counter()
+        try:
+            written = self.store.append(records)
+        except Exception as e:
+            logger.error(f"Failed to save database, will retry: {e}")
+            if METRICS_ENABLED:
+                metrics.inc("bot_db_write_errors_total")
+            return False
+        elapsed = (time.perf_counter() - started) * 1000
+        if METRICS_ENABLED:
+            metrics.observe("bot_db_flush_seconds", elapsed / 1000)
+            metrics.inc("bot_db_records_written_total", len(records))
+            metrics.inc("bot_db_mutations_total", mutations)
+            if written is not None:
+                metrics.inc("bot_db_bytes_written_total", written)
+        stats = self.stats
+        stats["flushes"] += 1
+        stats["mutations"] += mutations
+        stats["records"] += len(records)
+        stats["max_coalesced"] = max(stats["max_coalesced"], mutations)
+        stats["last_flush_ms"] = elapsed
+        stats["max_flush_ms"] = max(stats["max_flush_ms"], elapsed)
+        stats["total_flush_ms"] += elapsed
+        return True
+
+    async def flush(self):
+        """Write every pending change to the store."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._cancel_timer()
+            batch = self._drain()
+            loop = asyncio.get_running_loop()
+            if batch[1] and not await loop.run_in_executor(self._executor, self._write, batch):
+                self._restore(batch)
+                self._schedule(loop)
+                return
+            if self.store.needs_compaction():
+                await loop.run_in_executor(self._executor, self.store.compact, snapshot_db())
+
+    def close(self):
+        """Flush anything still pending and stop the worker thread."""
+        batch = self._drain()
+        if not self._write(batch):
+            self._restore(batch)
+        self._executor.shutdown(wait=True)
 
-def save_db():
-    """Save the database to the JSON file."""
+# === BACKUPS ===
+# /backup sends a gzip-compressed JSON document. A full one carries the data in
+# the snapshot file format; an incremental one carries the changed values since
+# the previous backup as records, and names that backup as its base so /restore
+# can insist on replaying a chain in order. Both carry the archived matches too:
+# a full one all of them, an incremental one those archived since its base plus
+# the IDs of every archived match, so archive rows removed meanwhile go as well.
+
+class BackupJournal:
+    """Paths changed since the last backup or restore, in first-change order."""
+
+    def __init__(self):
+        self.changed = {}
+        self.base = None  # ID of the last backup or restore; None until the first one since startup
+        self.archived = 0  # archive IDs up to this one are in the last backup or restore
+
+    def mark(self, path):
+        if () in self.changed:
+            return
+        if not path:
+            self.changed = {}
+        self.changed.pop(path, None)
+        self.changed[path] = None
+
+    def reset(self, backup_id, archived=0):
+        self.changed = {}
+        self.base = backup_id
+        self.archived = archived
+
+    def begin(self, backup_id, archived):
+        """Start a new journal for a backup being sent; returns the old state for abort()."""
+        previous = self.changed, self.base, self.archived
+        self.reset(backup_id, archived)
+        return previous
+
+    def abort(self, previous):
+        """Undo begin() after the backup failed, keeping changes made since."""
+        changed, self.base, self.archived = previous
+        for path in self.changed:
+            if () in changed:
+                break
+            changed.pop(path, None)
+            changed[path] = None
+        self.changed = changed
+
+backup_journal = BackupJournal()
+
+def backup_document(incremental=False):
+    """Point-in-time backup document and ArchiveExport; call on the event loop thread so they are consistent.
+
+    The archived matches are left to write_backup(), which reads them off the loop.
+    """
+    now = datetime.now(timezone.utc)
+    document = {"format": BACKUP_FORMAT, "id": now.strftime("%Y%m%dT%H%M%S.%fZ"), "created": now.isoformat()}
+    if incremental:
+        # After /clear the archive starts again from ID 1.
+        after = 0 if () in backup_journal.changed else backup_journal.archived
+        document.update(kind="incremental", base=backup_journal.base,
+                        records=[replica_record(path) for path in backup_journal.changed])
+        return document, archive.export(after)
+    document.update(kind="full", data=snapshot_db())
+    return document, archive.export()
+
+def write_backup(document, archived):
+    """Stream `document` as gzip-compressed JSON into a temporary file, with the rows of ArchiveExport `archived`.
+
+    Runs in a worker thread and closes `archived`; returns the file's path and the number of archived matches in it.
+    """
+    count = 0
+    fd, path = tempfile.mkstemp(suffix=".json.gz")
     try:
-        with open(DATA_FILE, "w") as f:
-            json.dump(db, f)
-    except Exception as e:
-        logger.error(f"Failed to save database: {e}")
+        with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(json.dumps(document, separators=(",", ":"))[:-1])
+            if document["kind"] == "incremental":
+                f.write(',"archive_ids":' + json.dumps(archived.ids(), separators=(",", ":")))
+            f.write(',"archive":[')
+            for row in archived.rows():
+                f.write("," if count else "")
+                json.dump(row, f, separators=(",", ":"))
+                count += 1
+            f.write("]}")
+    except BaseException:
+        os.unlink(path)
+        raise
+    finally:
+        archived.close()
+    return path, count
+
+def read_backup(blob):
+    """Parse and check an uploaded backup (gzip or plain JSON); returns the document.
+
+    A bare snapshot, such as an old match_data.json, is accepted as a full backup.
+    Raises ValueError describing the first problem found.
+    """
+    if blob[:2] == b"\x1f\x8b":
+        try:
+            blob = gzip.decompress(blob)
+        except (OSError, EOFError, zlib.error) as e:
+            raise ValueError(f"not a readable gzip file ({e})")
+    try:
+        document = json.loads(blob.decode("utf-8-sig"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"not valid JSON ({e})")
+    if isinstance(document, dict) and "format" not in document and "matches" in document:
+        document = {"format": BACKUP_FORMAT, "kind": "full", "id": None, "data": document}
+    if not isinstance(document, dict) or document.get("format") != BACKUP_FORMAT:
+        raise ValueError("not a backup made by /backup")
+    if document.get("kind") == "full":
+        check_snapshot(document.get("data"))
+    elif document.get("kind") == "incremental":
+        records = document.get("records")
+        if not isinstance(records, list) or not all(
+            isinstance(r, list) and len(r) in (2, 3) and r[0] in ("set", "del") and isinstance(r[1], list)
+            and (r[0] == "del") == (len(r) == 2)
+            for r in records
+        ):
+            raise ValueError("malformed change records")
+        for record in records:
+            if not record[1] and record[0] == "set":
+                check_snapshot(record[2])
+    else:
+        raise ValueError(f"unknown backup kind {document.get('kind')!r}")
+    if "archive" in document:
+        check_archive(document["archive"], document.get("archive_ids", [] if document["kind"] == "full" else None))
+    return document
+
+def check_snapshot(data):
+    """Raise ValueError unless `data` has the database layout."""
+    def require(condition, what):
+        if not condition:
+            raise ValueError(f"bad {what}")
+
+    require(isinstance(data, dict), "data")
+    for key in ("matches", "user_teams", "points", "amounts"):
+        require(isinstance(data.get(key), dict), key)
+    for match, info in data["matches"].items():
+        require(isinstance(info, dict) and isinstance(info.get("teams"), dict)
+                and isinstance(info.get("players"), list), f"match {match}")
+        require(all(isinstance(players, list) for players in info["teams"].values()), f"teams of {match}")
+    for user_id, matches in data["user_teams"].items():
+        require(isinstance(matches, dict) and all(
+            isinstance(team, list) and all(isinstance(p, (int, str)) for p in team) for team in matches.values()
+        ), f"teams of user {user_id}")
+    require(all(isinstance(v, (int, float)) for v in data["points"].values()), "points")
+    for user_id, bets in data["amounts"].items():
+        require(isinstance(bets, dict) and all(isinstance(v, int) for v in bets.values()), f"bets of user {user_id}")
+    archived = data.get("archived_scores", {})
+    require(isinstance(archived, dict) and all(isinstance(v, int) for v in archived.values()), "archived scores")
+    registry = data.get("registry", {})
+    require(isinstance(registry, dict) and all(isinstance(names, list) for names in registry.values()), "registry")
+
+def check_archive(rows, ids):
+    """Raise ValueError unless `rows` are MatchArchive.export() rows and `ids` archive IDs."""
+    if not isinstance(ids, (list, tuple)) or not all(isinstance(i, int) for i in ids):
+        raise ValueError("bad archive IDs")
+    for row in rows if isinstance(rows, list) else [None]:
+        if not (
+            isinstance(row, list) and len(row) == 6 and isinstance(row[0], int) and isinstance(row[1], str)
+            and isinstance(row[2], (int, float)) and isinstance(row[3], dict) and isinstance(row[4], dict)
+            and isinstance(row[5], list) and all(
+                isinstance(e, list) and len(e) == 4 and isinstance(e[0], str) and isinstance(e[1], list)
+                and (e[2] is None or isinstance(e[2], int)) and isinstance(e[3], int)
+                for e in row[5]
+            )
+        ):
+            raise ValueError("bad archived match")
+
+# === REGISTRY ===
+class Registry:
+    """Stable integer IDs for names, each name kept as a single interned string."""
+
+    __slots__ = ("names", "ids")
+
+    def __init__(self, names=()):
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.intern(name)
+
+    def intern(self, name):
+        """Return the ID for `name`, assigning the next free one if it is new."""
+        index = self.ids.get(name)
+        if index is None:
+            name = sys.intern(name)
+            index = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def name(self, index):
+        """Return the name registered under `index`, or None if there is none."""
+        return self.names[index] if 0 <= index < len(self.names) else None
+
+# db["registry"] holds the same name lists, so saving ("registry", kind) persists them.
+registries = {"matches": Registry(), "teams": Registry(), "players": Registry()}
+
+def sync_registries(path):
+    """Rebuild the registries from db["registry"] after a change at `path` was applied there directly."""
+    if not path or path[0] == "registry":
+        stored = db.setdefault("registry", {})
+        for kind in registries if len(path) < 2 else (path[1],):
+            registries[kind] = Registry(stored.get(kind, ()))
+            stored[kind] = registries[kind].names
+
+def register(kind, names):
+    """Intern `names` and persist the registry if any of them are new; returns the interned names."""
+    registry = registries[kind]
+    size = len(registry.names)
+    interned = [registry.names[registry.intern(name)] for name in names]
+    if len(registry.names) != size:
+        save_db("registry", kind)
+    return interned
+
+def encode_teams(value, depth=1):
+    """Replace player names by registry IDs in a user_teams subtree `depth` levels below db."""
+    if depth == 3:
+        ids = registries["players"].ids
+        return [ids.get(p, p) for p in value]
+    return {key: encode_teams(sub, depth + 1) for key, sub in list(value.items())}
+
+def encode_db(state):
+    """Compact on-disk form of the database: user teams reference players by ID."""
+    data = dict(state)
+    data["user_teams"] = encode_teams(state["user_teams"])
+    return data
+
+def decode_db(data):
+    """Rebuild the registries from loaded data and turn stored player IDs back into names.
+
+    Files written before the registry existed only have names; those are
+    registered here. Returns True if that added anything, so the caller can
+    write the migrated layout out.
+    """
+    stored = data.get("registry") or {}
+    for kind in registries:
+        registries[kind] = Registry(stored.get(kind, ()))
+    sizes = [len(r.names) for r in registries.values()]
+    for match, info in data["matches"].items():
+        registries["matches"].intern(match)
+        for team, players in info["teams"].items():
+            registries["teams"].intern(team)
+            info["teams"][team] = [registries["players"].names[registries["players"].intern(p)] for p in players]
+        info["players"] = [registries["players"].names[registries["players"].intern(p)] for p in info["players"]]
+    players = registries["players"]
+    for matches in data["user_teams"].values():
+        for match, team in matches.items():
+            matches[match] = [
+                players.names[players.intern(p)] if isinstance(p, str) else players.name(p)
+                for p in team
+                if isinstance(p, str) or players.name(p) is not None
+            ]
+    data["registry"] = {kind: registry.names for kind, registry in registries.items()}
+    return sizes != [len(r.names) for r in registries.values()]
+
+def open_store():
+    """Create the storage backend selected by STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "sqlite":
+        legacy = WriteAheadStore(DATA_FILE, WAL_FILE)
+        return SqliteStore(SQLITE_FILE, legacy=legacy, encode=encode_db, decode=decode_db)
+    return WriteAheadStore(DATA_FILE, WAL_FILE, encode=encode_db, decode=decode_db)
+
+store = open_store()
+db = store.load()
+persistence = PersistenceScheduler(store)
+
+shard = None  # ShardLink of this process when running as a shard worker
+
+def refresh_indexes(path):
+    """Update everything derived from the database after the value at `path` changed."""
+    leaderboard.update(path)
+    match_stats.update(path)
+    render_cache.update(path)
+    archive.update(path)
+    player_index.update(path)
+    invalidate_keyboards(path)
+    backup_journal.mark(path)
+
+@timed("db", "save_db")
+def save_db(*path):
+    """Mark the value at `path` in the database as changed (the whole database if no path is given)."""
+    refresh_indexes(path)
+    persistence.mark(path)
+    if shard is not None:
+        shard.publish(path)
+
+def replace_db(data):
+    """Swap in `data` as the whole database and save it, for /clear and /restore.
+
+    A shard worker must not write other workers' users, so it saves every
+    top-level key but the users' teams and bets, and then its own users, with
+    the other workers doing the same for theirs once the change reaches them.
+    """
+    users = own_users()
+    keys = set(db)
+    db.clear()
+    db.update(data)
+    sync_registries(())
+    if shard is None:
+        save_db()
+        return
+    refresh_indexes(())
+    for key in keys | set(db):
+        if key not in USER_KEYS:
+            persistence.mark((key,))
+    shard.publish(())
+    save_own_users(users)
+
+# === LEADERBOARD ===
+ROLE_WEIGHTS = (4, 3)  # captain x2, vice-captain x1.5, kept doubled so scores stay integers
+PLAYER_WEIGHT = 2
+
+class Leaderboard:
+    """Incrementally maintained user rankings.
+
+    Scores are stored doubled so captain (x2) and vice-captain (x1.5) bonuses stay
+    exact integers. `holders` maps each player to the (user, match) teams that
+    picked them with their role weight, so a points change only touches those
+    users. `ranked` keeps (-score, first seen, user) in sorted order, which matches
+    the old stable sort by score and makes top-N and rank lookups logarithmic.
+    Each user's score starts from what their archived matches earned, kept
+    (doubled too) in db["archived_scores"].
+    """
+
+    def __init__(self):
+        self.holders = {}
+        self.teams = {}
+        self.points = {}
+        self.scores = {}
+        self.order = {}
+        self.archived = {}
+        self.ranked = SortedList()
+
+    def rebuild(self, data):
+        """Recompute every score from scratch."""
+        self.__init__()
+        self.points = dict(data["points"])
+        self.archived = dict(data.get("archived_scores", {}))
+        for uid, matches in data["user_teams"].items():
+            self._add_user(uid)
+            for match, players in matches.items():
+                self._set_team(uid, match, players)
+        for uid in self.archived:
+            self._add_user(uid)
+
+    def update(self, path):
+        """Bring the index up to date after the value at `path` changed."""
+        if not path or (path[0] == "user_teams" and len(path) < 3):
+            self.rebuild(db)
+        elif path[0] == "user_teams":
+            uid, match = path[1], path[2]
+            if uid in db["user_teams"]:
+                self._add_user(uid)
+            self._set_team(uid, match, db["user_teams"].get(uid, {}).get(match, ()))
+        elif path[0] == "points":
+            self.update_points(db["points"] if len(path) < 2 else (path[1],))
+        elif path[0] == "archived_scores":
+            self.update_archived()
+
+    def update_points(self, players):
+        """Rescore the users holding any of `players`, adjusting each user once."""
+        deltas = {}
+        for player in players:
+            new = db["points"].get(player, 0)
+            change = new - self.points.get(player, 0)
+            self.points[player] = new
+            if change:
+                for (uid, _), weight in self.holders.get(player, {}).items():
+                    deltas[uid] = deltas.get(uid, 0) + change * weight
+        for uid, delta in deltas.items():
+            if delta:
+                self._adjust(uid, delta)
+
+    def update_archived(self):
+        """Adjust each user whose total in db["archived_scores"] changed."""
+        old, self.archived = self.archived, dict(db.get("archived_scores", {}))
+        for uid in [*self.archived, *(uid for uid in old if uid not in self.archived)]:
+            if uid not in self.scores:
+                self._add_user(uid)
+                continue
+            delta = self.archived.get(uid, 0) - old.get(uid, 0)
+            if delta:
+                self._adjust(uid, delta)
+
+    def _add_user(self, uid):
+        if uid not in self.order:
+            self.order[uid] = len(self.order)
+            score = self.scores[uid] = self.archived.get(uid, 0)
+            self.ranked.add((-score, self.order[uid], uid))
+
+    def _set_team(self, uid, match, players):
+        key = (uid, match)
+        delta = 0
+        for player, weight in self.teams.pop(key, ()):
+            delta -= self.points.get(player, 0) * weight
+            picks = self.holders[player]
+            picks.pop(key, None)
+            if not picks:
+                del self.holders[player]
+        if players:
+            entries = tuple(
+                (player, ROLE_WEIGHTS[i] if i < len(ROLE_WEIGHTS) else PLAYER_WEIGHT)
+                for i, player in enumerate(players)
+            )
+            self.teams[key] = entries
+            for player, weight in entries:
+                delta += self.points.get(player, 0) * weight
+                self.holders.setdefault(player, {})[key] = weight
+        if delta and uid in self.scores:
+            self._adjust(uid, delta)
+
+    def _adjust(self, uid, delta):
+        score = self.scores[uid]
+        self.ranked.remove((-score, self.order[uid], uid))
+        self.scores[uid] = score + delta
+        self.ranked.add((-score - delta, self.order[uid], uid))
+
+    def team_score(self, uid, match):
+        """Doubled score of one user's team for `match` at the current points."""
+        return sum(self.points.get(player, 0) * weight for player, weight in self.teams.get((uid, match), ()))
+
+    def top(self, n):
+        """Return the best `n` users as (user_id, points) pairs."""
+        return [(uid, -score / 2) for score, _, uid in self.ranked.islice(0, n)]
+
+    def rank(self, uid):
+        """Return the 1-based rank and points of a user, or None if they have no team."""
+        if uid not in self.scores:
+            return None
+        score = self.scores[uid]
+        return self.ranked.index((-score, self.order[uid], uid)) + 1, score / 2
+
+leaderboard = Leaderboard()
+leaderboard.rebuild(db)
+
+class MatchStats:
+    """Per-match aggregates for the admin /stats dashboard.
+
+    `teams` and `bets` remember what each (user, match) last contributed, so a
+    change to one user's team or bet is applied as a diff against that instead
+    of rescanning every user. `entries` counts, per match, whether each user has
+    a team and/or a bet, so the participant count is a len().
+    """
+
+    def __init__(self):
+        self.teams = {}
+        self.bets = {}
+        self.matches = {}
+
+    def rebuild(self, data):
+        """Recompute every counter from scratch."""
+        self.__init__()
+        for uid, matches in data["user_teams"].items():
+            for match, players in matches.items():
+                self._set_team(uid, match, players)
+        for uid, matches in data["amounts"].items():
+            for match, amount in matches.items():
+                self._set_bet(uid, match, amount)
+
+    def update(self, path):
+        """Bring the counters up to date after the value at `path` changed."""
+        if not path or (path[0] in ("user_teams", "amounts") and len(path) < 3):
+            self.rebuild(db)
+        elif path[0] == "matches" and len(path) == 2 and path[1] not in db["matches"]:
+            self.matches.pop(path[1], None)
+        elif path[0] == "user_teams":
+            uid, match = path[1], path[2]
+            self._set_team(uid, match, db["user_teams"].get(uid, {}).get(match, ()))
+        elif path[0] == "amounts":
+            uid, match = path[1], path[2]
+            self._set_bet(uid, match, db["amounts"].get(uid, {}).get(match, 0))
+
+    def get(self, match):
+        """Counters of `match`: picks, captains and vice_captains (Counters by player), pool, bets, teams and entries."""
+        counters = self.matches.get(match)
+        if counters is None:
+            counters = self.matches[match] = {
+                "picks": Counter(), "captains": Counter(), "vice_captains": Counter(),
+                "pool": 0, "bets": 0, "teams": 0, "entries": {},
+            }
+        return counters
+
+    def _set_team(self, uid, match, players):
+        key = (uid, match)
+        counters = self.get(match)
+        old = self.teams.pop(key, ())
+        if old:
+            counters["picks"].subtract(old)
+            counters["captains"][old[0]] -= 1
+            if len(old) > 1:
+                counters["vice_captains"][old[1]] -= 1
+            counters["teams"] -= 1
+            self._leave(counters, uid)
+        if players:
+            new = self.teams[key] = tuple(players)
+            counters["picks"].update(new)
+            counters["captains"][new[0]] += 1
+            if len(new) > 1:
+                counters["vice_captains"][new[1]] += 1
+            counters["teams"] += 1
+            counters["entries"][uid] = counters["entries"].get(uid, 0) + 1
+
+    def _set_bet(self, uid, match, amount):
+        key = (uid, match)
+        counters = self.get(match)
+        old = self.bets.pop(key, 0)
+        if old:
+            counters["pool"] -= old
+            counters["bets"] -= 1
+            self._leave(counters, uid)
+        if amount:
+            self.bets[key] = amount
+            counters["pool"] += amount
+            counters["bets"] += 1
+            counters["entries"][uid] = counters["entries"].get(uid, 0) + 1
+
+    @staticmethod
+    def _leave(counters, uid):
+        left = counters["entries"][uid] - 1
+        if left:
+            counters["entries"][uid] = left
+        else:
+            del counters["entries"][uid]
+
+match_stats = MatchStats()
+match_stats.rebuild(db)
+
+# === ARCHIVE ===
+class ArchiveExport:
+    """The archive at one moment, for a backup written on a worker thread.
+
+    Create it on the event loop thread, next to snapshot_db(), so the two agree:
+    it starts a read transaction on its own connection right away, and leaves
+    out the matches an /archive in progress has written but not yet removed
+    from the database. ids() and rows() then read that state from any thread,
+    one match at a time; close() ends the transaction.
+    """
+
+    def __init__(self, path, pending, after=0):
+        self.after = after
+        self.pending = frozenset(pending)
+        self.conn = None
+        if os.path.exists(path):
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA busy_timeout=10000")
+            self.conn.execute("BEGIN")
+            # The first read fixes the snapshot the later reads see.
+            self.conn.execute("SELECT id FROM archived_matches LIMIT 1").fetchall()
+
+    def ids(self):
+        """IDs of every archived match whose match has left the database."""
+        if self.conn is None:
+            return []
+        return [i for i, in self.conn.execute("SELECT id FROM archived_matches ORDER BY id") if i not in self.pending]
+
+    def rows(self):
+        """Yield the matches with an ID above `after` as [id, name, archived, info, points, entries]."""
+        if self.conn is None:
+            return
+        matches = self.conn.execute(
+            "SELECT id, name, archived, info, points FROM archived_matches WHERE id > ? ORDER BY id", (self.after,)
+        ).fetchall()
+        for i, name, archived, info, points in matches:
+            if i in self.pending:
+                continue
+            entries = [
+                [uid, json.loads(players), amount, score]
+                for uid, players, amount, score in self.conn.execute(
+                    "SELECT user_id, players, amount, score FROM archived_entries WHERE match_id = ? ORDER BY rowid",
+                    (i,),
+                )
+            ]
+            yield [i, name, archived, json.loads(info), json.loads(points), entries]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+class MatchArchive:
+    """Finished matches, kept on disk and read only when a view asks for them.
+
+    /archive moves a locked match out of the database into a separate SQLite
+    file: the match record, the points of its players and each user's team,
+    bet and score, frozen at that moment. Only every user's total over archived
+    matches stays in memory (db["archived_scores"]), for /rankings. The file is
+    opened on first use and read through a memory map, so startup time and
+    memory depend on the active matches alone. Every archived match gets its own
+    ID, so a match name can come back in a later season.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archived_matches (
+            id INTEGER PRIMARY KEY, name TEXT NOT NULL, archived REAL NOT NULL, info TEXT NOT NULL, points TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS archived_matches_by_name ON archived_matches (name);
+        CREATE TABLE IF NOT EXISTS archived_entries (
+            match_id INTEGER NOT NULL, user_id TEXT NOT NULL, players TEXT NOT NULL, amount INTEGER,
+            score INTEGER NOT NULL, PRIMARY KEY (match_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS archived_entries_by_user ON archived_entries (user_id, match_id);
+    """
+
+    def __init__(self, path, cache_size=ARCHIVE_CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.conn = None
+        self.pending = set()  # IDs written by put() whose match is still in the database
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA busy_timeout=10000")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(self.SCHEMA)
+        return conn
+
+    def _reader(self, create=False):
+        """Connection for the event loop thread; None while nothing was ever archived, unless `create`."""
+        if self.conn is None and (create or os.path.exists(self.path)):
+            self.conn = self._connect()
+            self.conn.execute(f"PRAGMA mmap_size={ARCHIVE_MMAP_BYTES}")
+        return self.conn
+
+    def put(self, name, entry):
+        """Write an archive_entry() of match `name` in one transaction; returns its archive ID.
+
+        Opens its own connection, so it can run in a worker thread.
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                archived_id = conn.execute(
+                    "INSERT INTO archived_matches (name, archived, info, points) VALUES (?, ?, ?, ?)",
+                    (name, time.time(), json.dumps(entry["info"]), json.dumps(entry["points"])),
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO archived_entries (match_id, user_id, players, amount, score) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (archived_id, uid, json.dumps(players, separators=(",", ":")), amount, score)
+                        for uid, players, amount, score in entry["entries"]
+                    ],
+                )
+                # Registered before the commit, so no backup can see the row without knowing it is pending.
+                self.pending.add(archived_id)
+            return archived_id
+        finally:
+            conn.close()
+
+    def discard(self, archived_id):
+        """Remove an archived match again; runs in a worker thread like put()."""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM archived_entries WHERE match_id = ?", (archived_id,))
+                conn.execute("DELETE FROM archived_matches WHERE id = ?", (archived_id,))
+        finally:
+            conn.close()
+        self.pending.discard(archived_id)
+
+    def mark(self):
+        """Highest ID up to which export() has nothing left to add."""
+        if self.pending:
+            return min(self.pending) - 1
+        conn = self._reader()
+        return conn.execute("SELECT coalesce(max(id), 0) FROM archived_matches").fetchone()[0] if conn else 0
+
+    def export(self, after=0):
+        """An ArchiveExport of the matches with an ID above `after`, as the archive is now."""
+        return ArchiveExport(self.path, self.pending, after)
+
+    def restore(self, rows, keep=None):
+        """Load export() rows from a backup, removing the archived matches not in `keep` (all if None).
+
+        Rows an /archive still in progress has written stay; it drops them itself
+        if the restore changed its match.
+        """
+        conn = self._reader(create=True)
+        keep = json.dumps([*(keep or ()), *self.pending])
+        with conn:
+            conn.execute("DELETE FROM archived_entries WHERE match_id NOT IN (SELECT value FROM json_each(?))", (keep,))
+            conn.execute("DELETE FROM archived_matches WHERE id NOT IN (SELECT value FROM json_each(?))", (keep,))
+            for archived_id, name, archived, info, points, entries in rows:
+                conn.execute("DELETE FROM archived_entries WHERE match_id = ?", (archived_id,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO archived_matches (id, name, archived, info, points) VALUES (?, ?, ?, ?, ?)",
+                    (archived_id, name, archived, json.dumps(info), json.dumps(points)),
+                )
+                conn.executemany(
+                    "INSERT INTO archived_entries (match_id, user_id, players, amount, score) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (archived_id, uid, json.dumps(players, separators=(",", ":")), amount, score)
+                        for uid, players, amount, score in entries
+                    ],
+                )
+        self.cache.clear()
+
+    def clear(self):
+        """Forget every archived match."""
+        conn = self._reader()
+        if conn is not None:
+            with conn:
+                conn.execute("DELETE FROM archived_entries")
+                conn.execute("DELETE FROM archived_matches")
+        self.cache.clear()
+
+    def update(self, path):
+        """Drop cached entries once a change at `path` may have archived more matches."""
+        if not path or path[0] == "archived_scores":
+            self.cache.clear()
+
+    def _cached(self, key, query, args):
+        rows = self.cache.get(key)
+        if rows is not None:
+            self.cache.move_to_end(key)
+            return rows
+        conn = self._reader()
+        if conn is None:
+            return []
+        rows = self.cache[key] = [
+            (first, json.loads(players), amount, score) for first, players, amount, score in conn.execute(query, args)
+        ]
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return rows
+
+    def entries(self, user_id):
+        """(match, players, bet or None, doubled score) of each archived match `user_id` took part in, oldest first."""
+        return self._cached(
+            ("user", user_id),
+            "SELECT m.name, e.players, e.amount, e.score FROM archived_entries e "
+            "JOIN archived_matches m ON m.id = e.match_id WHERE e.user_id = ? ORDER BY e.match_id",
+            (user_id,),
+        )
+
+    def match_entries(self, archived_id):
+        """(user, players, bet or None, doubled score) of everyone in an archived match."""
+        return self._cached(
+            ("match", archived_id),
+            "SELECT user_id, players, amount, score FROM archived_entries WHERE match_id = ? ORDER BY rowid",
+            (archived_id,),
+        )
+
+    def find(self, name):
+        """Archive ID of the latest archived match called `name`, or None."""
+        conn = self._reader()
+        row = conn and conn.execute(
+            "SELECT id FROM archived_matches WHERE name = ? ORDER BY id DESC LIMIT 1", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+archive = MatchArchive(ARCHIVE_FILE)
+
+def archive_entry(match):
+    """Everything /archive keeps of `match`, as it stands now."""
+    info = freeze(db["matches"][match])
+    points = {player: db["points"][player] for player in info["players"] if player in db["points"]}
+    entries = []
+    for uid in dict.fromkeys([*db["user_teams"], *db["amounts"]]):
+        players = db["user_teams"].get(uid, {}).get(match)
+        amount = db["amounts"].get(uid, {}).get(match)
+        if players is not None or amount is not None:
+            entries.append((uid, list(players or ()), amount, leaderboard.team_score(uid, match)))
+    return {"info": info, "points": points, "entries": entries}
+
+def remove_archived(match, entry):
+    """Drop an archived match from the database, adding its scores to db["archived_scores"].
+
+    Users keep their (possibly empty) entries in user_teams and amounts, so
+    they still count as users of the bot. Points of players in no other active
+    match are dropped with it.
+    """
+    scores = db.setdefault("archived_scores", {})
+    changed = []
+    for uid, _, _, score in entry["entries"]:
+        if db["user_teams"].get(uid, {}).pop(match, None) is not None:
+            changed.append(("user_teams", uid, match))
+        if db["amounts"].get(uid, {}).pop(match, None) is not None:
+            changed.append(("amounts", uid, match))
+        if score:
+            scores[uid] = scores.get(uid, 0) + score
+    del db["matches"][match]
+    active = {player for info in db["matches"].values() for player in info["players"]}
+    for player in entry["points"]:
+        if player not in active:
+            del db["points"][player]
+            changed.append(("points", player))
+    # Teams go before points so the leaderboard never rescores a removed team.
+    for path in changed:
+        save_db(*path)
+    save_db("archived_scores")
+    save_db("matches", match)
+
+# === SETTLEMENT ===
+# /settle shares the bet pool of a finished match, less SETTLE_COMMISSION, among
+# the users who bet on it. A rule is either the fractions of the prize going to
+# 1st, 2nd, ... place by score, where users tied on score split the fractions
+# of the places they take, or None to pay out in proportion to bet x score.
+POOL_RULES = {
+    "winner": (1.0,),
+    "top3": (0.5, 0.3, 0.2),
+    "proportional": None,
+}
+
+class PlayerColumns(dict):
+    """Player -> matrix column, numbering players as they are first looked up."""
+
+    def __missing__(self, player):
+        index = self[player] = len(self)
+        return index
+
+def team_scores(teams, points):
+    """Score of each team in `teams` (lists of players, captain first) at `points`.
+
+    Builds a teams x players matrix of role weights and multiplies it by the
+    points vector, so the per-pick work left in Python is one dict lookup.
+    """
+    lengths = np.fromiter(map(len, teams), dtype=np.int64, count=len(teams))
+    total = int(lengths.sum())
+    columns = PlayerColumns()
+    cols = np.fromiter(map(columns.__getitem__, itertools.chain.from_iterable(teams)), dtype=np.int64, count=total)
+    rows = np.repeat(np.arange(len(teams)), lengths)
+    positions = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    position_weights = np.full(max(int(lengths.max(initial=0)), len(ROLE_WEIGHTS)), PLAYER_WEIGHT / 2)
+    position_weights[:len(ROLE_WEIGHTS)] = np.array(ROLE_WEIGHTS) / 2
+    matrix = np.zeros((len(teams), len(columns)))
+    # A player is in a team at most once, so no cell is written twice.
+    matrix[rows, cols] = position_weights[positions]
+    vector = np.fromiter((points.get(player, 0) for player in columns), dtype=np.float64, count=len(columns))
+    return matrix @ vector
+
+def match_bettors(match):
+    """Users who bet on active `match`, with their bets and team scores as arrays."""
+    users, bets, teams = [], [], []
+    for uid, user_bets in db["amounts"].items():
+        amount = user_bets.get(match)
+        if amount is not None:
+            users.append(uid)
+            bets.append(amount)
+            teams.append(db["user_teams"].get(uid, {}).get(match, ()))
+    return users, np.array(bets, dtype=np.float64), team_scores(teams, db["points"])
+
+def archived_bettors(archived_id):
+    """Like match_bettors(), for an archived match, with the scores frozen when it was archived."""
+    entries = [entry for entry in archive.match_entries(archived_id) if entry[2] is not None]
+    bets = np.array([entry[2] for entry in entries], dtype=np.float64)
+    scores = np.array([entry[3] for entry in entries], dtype=np.float64) / 2
+    return [entry[0] for entry in entries], bets, scores
+
+def settle_pool(bets, scores, rule, commission=SETTLE_COMMISSION):
+    """Payout of each bettor under pool rule `rule`, in whole points (the remainder stays in the pool)."""
+    prize = bets.sum() * (1 - commission)
+    shares = POOL_RULES[rule]
+    if shares is None:
+        stakes = bets * np.maximum(scores, 0)
+        # Nobody scored: hand the prize back in proportion to the bets.
+        payouts = prize * (stakes if stakes.any() else bets) / (stakes.sum() or bets.sum())
+    else:
+        order = np.argsort(-scores, kind="stable")
+        ranked = scores[order]
+        places = np.zeros(len(bets))
+        places[:len(shares)] = shares[:len(bets)]
+        places /= places.sum()
+        _, group, counts = np.unique(-ranked, return_inverse=True, return_counts=True)
+        payouts = np.empty(len(bets))
+        payouts[order] = prize * (np.bincount(group, weights=places) / counts)[group]
+    return np.floor(payouts + 1e-9)
+
+# === BROADCAST ===
+class RateLimiter:
+    """Token bucket for the bot's overall send rate plus a minimum gap per chat.
+
+    Tokens may go negative: each caller reserves the next free slot and sleeps
+    until it, so concurrent senders are spaced out without a lock.
+    """
+
+    def __init__(self, rate=SEND_RATE, per_chat_interval=PER_CHAT_INTERVAL):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.next_for_chat = {}
+
+    async def acquire(self, chat_id):
+        """Wait until a message may be sent to `chat_id`."""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - 1
+        self.updated = now
+        wait = max(-self.tokens / self.rate, self.next_for_chat.get(chat_id, 0) - now, 0)
+        if len(self.next_for_chat) > 10000:
+            self.next_for_chat = {c: t for c, t in self.next_for_chat.items() if t > now}
+        self.next_for_chat[chat_id] = now + wait + self.per_chat_interval
+        if wait:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every sender back after Telegram asks us to slow down."""
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+limiter = RateLimiter()
+
+async def send_with_retry(bot, chat_id, text, **kwargs):
+    """Send a message through the rate limiter, retrying flood-wait and network errors."""
+    for attempt in range(SEND_RETRIES + 1):
+        await limiter.acquire(chat_id)
+        try:
+            return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except RetryAfter as e:
+            if attempt == SEND_RETRIES:
+                raise
+            logger.warning(f"Flood limit hit sending to {chat_id}, retrying in {e.retry_after}s")
+            limiter.pause(float(e.retry_after))
+        except NetworkError:
+            if attempt == SEND_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+async def broadcast(bot, chat_ids, text, report=None, **kwargs):
+    """Send `text` to every chat in `chat_ids` and return delivery counts.
+
+    Chat IDs are fed through a bounded queue to BROADCAST_WORKERS senders that
+    share the rate limiter. `report` is awaited with the running counts every
+    BROADCAST_PROGRESS_EVERY seconds.
+    """
+    queue = asyncio.Queue(maxsize=BROADCAST_WORKERS * 4)
+    stats = {"sent": 0, "blocked": 0, "failed": 0, "started": time.monotonic()}
+
+    async def produce():
+        for chat_id in chat_ids:
+            await queue.put(chat_id)
+        for _ in range(BROADCAST_WORKERS):
+            await queue.put(None)
+
+    async def worker():
+        while (chat_id := await queue.get()) is not None:
+            try:
+                await send_with_retry(bot, chat_id, text, **kwargs)
+                stats["sent"] += 1
+            except Forbidden:
+                stats["blocked"] += 1
+            except TelegramError as e:
+                stats["failed"] += 1
+                logger.warning(f"Broadcast to {chat_id} failed: {e}")
+
+    tasks = [asyncio.create_task(produce())] + [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+    pending = set(tasks)
+    while pending:
+        _, pending = await asyncio.wait(pending, timeout=BROADCAST_PROGRESS_EVERY)
+        if pending and report:
+            await report(stats)
+    stats["elapsed"] = time.monotonic() - stats["started"]
+    return stats
+
+def broadcast_summary(stats, total, done=True):
+    """Format broadcast counts for the admin."""
+    elapsed = stats.get("elapsed", time.monotonic() - stats["started"])
+    delivered = stats["sent"] + stats["blocked"] + stats["failed"]
+    return (
+        f"{'✅ Broadcast finished' if done else '📤 Broadcasting'}: {delivered}/{total}\n"
+        f"Sent: {stats['sent']}, blocked the bot: {stats['blocked']}, failed: {stats['failed']}\n"
+        f"Elapsed: {elapsed:.0f}s ({stats['sent'] / elapsed if elapsed else 0:.1f} msg/s)"
+    )
+
+# === PAGINATION ===
+def role_label(i):
+    """Suffix shown after a player at position `i` of a team."""
+    return " (Captain)" if i == 0 else " (Vice-Captain)" if i == 1 else ""
+
+def team_items(owner):
+    return list(db["user_teams"])
+
+def render_team_item(owner, user_id):
+    lines = [f"User ID: {user_id}\n"]
+    for match, players in db["user_teams"].get(user_id, {}).items():
+        lines.append(f"  Match: {match}\n")
+        if not players:
+            lines.append("    No players selected.\n")
+        else:
+            lines.extend(f"    - {player}{role_label(i)}\n" for i, player in enumerate(players))
+            bet = db["amounts"].get(user_id, {}).get(match)
+            if bet is not None:
+                lines.append(f"    Bet: {bet} points\n")
+        lines.append("\n")
+    lines.append("-" * 20 + "\n")
+    return "".join(lines)
+
+def render_archived(heading, entry):
+    """One archived team: `heading`, its players and the bet and points it got."""
+    _, players, amount, score = entry
+    lines = [f"{heading}\n", *(f"- {p}{role_label(i)}\n" for i, p in enumerate(players))]
+    if amount is not None:
+        lines.append(f"Bet: {amount} points\n")
+    lines.append(f"Points: {score / 2:g}\n\n")
+    return "".join(lines)
+
+def profile_items(user_id):
+    teams = db["user_teams"].get(user_id) or {}
+    bets = db["amounts"].get(user_id) or {}
+    items = [("teams",)] + [("team", m) for m in teams] if teams else [("no_teams",)]
+    items += [("bets",)] + [("bet", m) for m in bets] if bets else [("no_bets",)]
+    past = archive.entries(user_id)
+    if past:
+        items += [("history",)] + [("past", i) for i in range(len(past))]
+    return items
+
+def render_profile_item(user_id, item):
+    kind = item[0]
+    if kind == "no_teams":
+        return "No teams selected yet.\n"
+    if kind == "teams":
+        return "Your Teams:\n"
+    if kind == "team":
+        players = db["user_teams"].get(user_id, {}).get(item[1], [])
+        return "".join([f"{item[1]}:\n", *(f"- {p}{role_label(i)}\n" for i, p in enumerate(players)), "\n"])
+    if kind == "no_bets":
+        return "No bets placed yet.\n"
+    if kind == "bets":
+        return "Your Bets:\n"
+    if kind == "history":
+        return "\nPast Matches:\n"
+    if kind == "past":
+        entry = archive.entries(user_id)[item[1]]
+        return render_archived(f"{entry[0]}:", entry)
+    return f"{item[1]}: {db['amounts'].get(user_id, {}).get(item[1])} points\n"
+
+def check_items(user_id):
+    return list(db["user_teams"].get(user_id, {})) + [("past", i) for i in range(len(archive.entries(user_id)))]
+
+def render_check_item(user_id, match):
+    if isinstance(match, tuple):
+        entry = archive.entries(user_id)[match[1]]
+        return render_archived(f"{entry[0]} (archived):", entry)
+    players = db["user_teams"].get(user_id, {}).get(match, [])
+    lines = [f"{match}:\n", *(f"- {p}{role_label(i)}\n" for i, p in enumerate(players))]
+    bet = db["amounts"].get(user_id, {}).get(match)
+    if bet is not None:
+        lines.append(f"Bet: {bet} points\n")
+    lines.append("\n")
+    return "".join(lines)
+
+def archived_team_items(archived_id):
+    return archive.match_entries(int(archived_id))
+
+def render_archived_team_item(archived_id, entry):
+    return render_archived(f"User ID: {entry[0]}", entry)
+
+# view name -> (items, render one item, header, parse mode, admin only)
+# The owner of an admin view, if any, is carried in its Prev/Next buttons.
+PAGED_VIEWS = {
+    "team": (team_items, render_team_item, "📋 *User Teams for Verification* 📋\n\n", "Markdown", True),
+    "archived": (archived_team_items, render_archived_team_item, "📋 *Archived Teams* 📋\n\n", "Markdown", True),
+    "profile": (profile_items, render_profile_item, "📋 *Your Profile* 📋\n\n", "Markdown", False),
+    "check": (check_items, render_check_item, "Your teams:\n\n", None, False),
+}
+
+def render_page(view, owner, anchor=0, backwards=False):
+    """Render one page of a view, starting at item `anchor` or ending just before it.
+
+    Only the items that land on the page are formatted, and the page is joined
+    once, so it always fits in a single Telegram message.
+    """
+    list_items, render_item, header, parse_mode, admin_only = PAGED_VIEWS[view]
+    items = list_items(owner)
+    scope = (owner,) if admin_only and owner is not None else ()
+    budget = PAGE_CHARS - len(header)
+    parts = []
+    step = -1 if backwards else 1
+    i = anchor - 1 if backwards else anchor
+    while 0 <= i < len(items):
+        text = render_item(owner, items[i])
+        if len(text) > budget:
+            if parts:
+                break
+            text = text[:budget - 2] + "…\n"
+        parts.append(text)
+        budget -= len(text)
+        i += step
+    if backwards:
+        parts.reverse()
+        first, end = i + 1, anchor
+    else:
+        first, end = anchor, i
+    buttons = []
+    if first > 0:
+        buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=encode_callback("pg", view, first, "b", *scope)))
+    if end < len(items):
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=encode_callback("pg", view, end, "f", *scope)))
+    markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return header + "".join(parts), markup, parse_mode
+
+class RenderCache:
+    """LRU cache of rendered pages of the per-user views (/profile, /check).
+
+    `versions` counts changes to each user's teams and bets. A cached page
+    remembers the version it was rendered from and is only served while that
+    still matches, so a change never has to hunt down stale pages; they just
+    age out of the LRU. At most `size` pages are kept.
+    """
+
+    def __init__(self, size=RENDER_CACHE_SIZE):
+        self.size = size
+        self.versions = {}
+        self.pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, path):
+        """Bump the version of the user whose data changed at `path`."""
+        if not path or (path[0] in ("user_teams", "amounts") and len(path) < 2):
+            self.pages.clear()
+        elif path[0] in ("user_teams", "amounts"):
+            self.versions[path[1]] = self.versions.get(path[1], 0) + 1
+
+    def render(self, view, owner, anchor=0, backwards=False):
+        """render_page() through the cache; admin views are rendered directly."""
+        if PAGED_VIEWS[view][4]:
+            return render_page(view, owner, anchor, backwards)
+        key = (view, owner, anchor, backwards)
+        version = self.versions.get(owner, 0)
+        entry = self.pages.get(key)
+        if entry is not None and entry[0] == version:
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        page = render_page(view, owner, anchor, backwards)
+        self.pages[key] = (version, page)
+        self.pages.move_to_end(key)
+        if len(self.pages) > self.size:
+            self.pages.popitem(last=False)
+        return page
+
+render_cache = RenderCache()
+
+# === MATCH LOCKS ===
+# Match records carry "locked" (set by /lockmatch or when the match starts) and
+# "start" (Unix timestamp of the deadline, or None), saved with the rest of the data.
+
+def is_locked(match):
+    """True once `match` is locked or its start time has passed, even if the lock job hasn't run yet."""
+    info = db["matches"].get(match)
+    if info is None:
+        return False
+    start = info.get("start")
+    return info.get("locked", False) or (start is not None and time.time() >= start)
+
+def parse_start(text):
+    """Parse an admin-supplied start time ("YYYY-MM-DD HH:MM", MATCH_TIMEZONE unless it has an offset)."""
+    moment = datetime.fromisoformat(text)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=MATCH_TIMEZONE)
+    return moment.timestamp()
+
+def format_start(start):
+    return datetime.fromtimestamp(start, MATCH_TIMEZONE).strftime("%Y-%m-%d %H:%M")
+
+def lock(match):
+    """Lock `match` against further team edits and bets."""
+    db["matches"][match]["locked"] = True
+    save_db("matches", match, "locked")
+
+def schedule_lock(job_queue, match):
+    """(Re)schedule the job that locks `match` at its start time."""
+    if job_queue is None:
+        return
+    for job in job_queue.get_jobs_by_name(f"lock:{match}"):
+        job.schedule_removal()
+    info = db["matches"].get(match)
+    if info is None or info.get("locked") or info.get("start") is None:
+        return
+    job_queue.run_once(
+        auto_lock, max(0, info["start"] - time.time()), data=(match, info["start"]), name=f"lock:{match}"
+    )
+
+async def auto_lock(context: ContextTypes.DEFAULT_TYPE):
+    """Job callback locking a match at its start time."""
+    match, start = context.job.data
+    info = db["matches"].get(match)
+    if info is not None and info.get("start") == start and not info.get("locked"):
+        lock(match)
+        logger.info("Match %s locked at its start time", match)
+
+# === LOCKING ===
+class LockManager:
+    """Sharded asyncio locks for users and matches.
+
+    Keys hash onto a fixed pool of LOCK_SHARDS locks per kind, so memory stays
+    bounded however many users there are; keys that share a shard just wait for
+    each other. User handlers hold their user's lock for the whole update, so
+    quick repeated taps are applied and answered one at a time. Admin changes to
+    a match hold that match's lock. Checks of shared state, like whether a match
+    is locked, run without an await before the change they guard, so no handler
+    ever needs both kinds of lock.
+    """
+
+    def __init__(self, shards=LOCK_SHARDS):
+        self.users = [asyncio.Lock() for _ in range(shards)]
+        self.matches = [asyncio.Lock() for _ in range(shards)]
+
+    def user(self, user_id):
+        return self.users[hash(str(user_id)) % len(self.users)]
+
+    def match(self, match):
+        return self.matches[hash(match) % len(self.matches)]
+
+locks = LockManager()
+
+def user_locked(handler):
+    """Run a command handler while holding the lock of the user who sent it."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with locks.user(update.effective_user.id):
+            return await handler(update, context)
+    return wrapper
+
+def match_locked(handler):
+    """Run an admin command handler while holding the lock of the match named by its first argument."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not context.args:
+            return await handler(update, context)
+        async with locks.match(context.args[0]):
+            return await handler(update, context)
+    return wrapper
 
-locked_matches = {}
 
 def is_admin(user_id):
     """Check if the user is an admin."""
     return user_id in ADMIN_IDS
 
+# === THROTTLING ===
+class UpdateThrottle:
+    """Drops repeated button taps and updates from users going over their rate.
+
+    `recent` remembers when each (user, callback data) was last let through, in
+    that order, so expired taps are dropped from the front. `buckets` holds a
+    token bucket per user: USER_BURST tokens refilled at USER_RATE per second,
+    one taken per message or tap. Admins are never throttled.
+    """
+
+    def __init__(self, window=DUPLICATE_TAP_WINDOW, rate=USER_RATE, burst=USER_BURST):
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.recent = OrderedDict()
+        self.buckets = {}
+        self.max_buckets = 10000
+        self.dropped = Counter()
+
+    def check(self, update):
+        """Return why `update` should be dropped ("duplicate" or "throttled"), or None to handle it."""
+        user = update.effective_user
+        if user is None or is_admin(user.id) or not (update.callback_query or update.message):
+            return None
+        now = time.monotonic()
+        query = update.callback_query
+        if self.window and query is not None:
+            while self.recent and next(iter(self.recent.values())) <= now - self.window:
+                self.recent.popitem(last=False)
+            key = (user.id, query.data)
+            if key in self.recent:
+                self.dropped["duplicate"] += 1
+                return "duplicate"
+            self.recent[key] = now
+        if self.rate:
+            tokens, updated = self.buckets.get(user.id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if len(self.buckets) > self.max_buckets:
+                # Full buckets are the same as no bucket.
+                self.buckets = {
+                    uid: bucket for uid, bucket in self.buckets.items()
+                    if bucket[0] + (now - bucket[1]) * self.rate < self.burst
+                }
+                self.max_buckets = max(10000, 2 * len(self.buckets))
+            if tokens < 1:
+                self.buckets[user.id] = (tokens, now)
+                self.dropped["throttled"] += 1
+                return "throttled"
+            self.buckets[user.id] = (tokens - 1, now)
+        return None
+
+throttle = UpdateThrottle()
+
+async def throttle_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Runs before every other handler (group -1) and stops updates the throttle drops.
+
+    Dropped messages get no reply. A dropped tap is still answered, so the
+    button stops spinning: silently for a repeat of a tap being handled, with a
+    short notice for a user over their rate.
+    """
+    reason = throttle.check(update)
+    if reason is not None:
+        if METRICS_ENABLED:
+            metrics.inc("bot_updates_dropped_total", reason=reason)
+        query = update.callback_query
+        if query is not None:
+            await query.answer("⏳ Slow down a little, then try again." if reason == "throttled" else None)
+        raise ApplicationHandlerStop
+
+# === CALLBACK DATA ===
+# Buttons carry "<opcode>:<field>:..." with matches, teams and players referred to
+# by their registry IDs, which keeps callback_data far below Telegram's 64-byte
+# limit whatever the names are.
+def match_id(match):
+    return registries["matches"].ids[match]
+
+def team_id(team):
+    return registries["teams"].ids[team]
+
+def player_id(player):
+    return registries["players"].ids[player]
+
+def lookup(kind, index):
+    """Name for a registry ID taken from callback data, or None if it is unknown."""
+    return registries[kind].name(int(index))
+
+def encode_callback(op, *fields):
+    """Build callback_data for an opcode and its fields."""
+    return ":".join((op, *map(str, fields)))
+
+# === KEYBOARDS ===
+# match list kind -> (button opcode, include locked matches)
+MATCH_LISTS = {
+    "schedule": ("um", False),
+    "addamount": ("ba", False),
+    "editteam": ("et", False),
+    "admin": ("am", True),
+}
+keyboard_cache = {}
+
+def invalidate_keyboards(path=()):
+    """Drop cached keyboards affected by a change at `path` in the database."""
+    if not path:
+        keyboard_cache.clear()
+    elif path[0] == "matches":
+        match = path[1] if len(path) > 1 else None
+        field = path[2] if len(path) > 2 else None
+        for key in list(keyboard_cache):
+            if key[0] == "matches":
+                stale = field in (None, "locked", "start")
+            else:
+                stale = match in (None, key[1]) and field in (None, "teams", "players")
+            if stale:
+                del keyboard_cache[key]
+
+def paged_markup(key, rows, page, kind, scope=(), footer=()):
+    """Build and cache one page of `rows`, with Prev/Next buttons for the `kind` keyboard."""
+    pages = max(1, -(-len(rows) // KEYBOARD_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    keyboard = rows[page * KEYBOARD_PAGE_SIZE:(page + 1) * KEYBOARD_PAGE_SIZE]
+    if pages > 1:
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=encode_callback("kb", kind, page - 1, *scope)))
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="nop"))
+        if page < pages - 1:
+            buttons.append(InlineKeyboardButton("Next ▶️", callback_data=encode_callback("kb", kind, page + 1, *scope)))
+        keyboard.append(buttons)
+    keyboard.extend(footer)
+    markup = keyboard_cache[key + (page,)] = InlineKeyboardMarkup(keyboard)
+    return markup
+
+def match_list_keyboard(kind, page=0):
+    """Keyboard listing the matches for `kind`; locked matches are hidden from users."""
+    markup = keyboard_cache.get(("matches", kind, page))
+    if markup is None:
+        op, include_locked = MATCH_LISTS[kind]
+        rows = [
+            [InlineKeyboardButton(m, callback_data=encode_callback(op, match_id(m)))]
+            for m in db["matches"]
+            if include_locked or not is_locked(m)
+        ]
+        markup = paged_markup(("matches", kind), rows, page, kind)
+    return markup
+
+def teams_keyboard(match, page=0):
+    """Keyboard for choosing which team of `match` to pick players from."""
+    markup = keyboard_cache.get(("teams", match, page))
+    if markup is None:
+        mid = match_id(match)
+        rows = [
+            [InlineKeyboardButton(f"{team}", callback_data=encode_callback("st", mid, team_id(team)))]
+            for team in db["matches"][match]["teams"]
+        ]
+        search = [[search_button(match)]]
+        markup = paged_markup(("teams", match), rows, page, "teams", (mid,), search)
+    return markup
+
+def players_keyboard(match, team, page=0):
+    """Keyboard for picking players of one team in `match`."""
+    markup = keyboard_cache.get(("players", match, team, page))
+    if markup is None:
+        mid, tid = match_id(match), team_id(team)
+        rows = [
+            [InlineKeyboardButton(player, callback_data=encode_callback("sp", mid, tid, player_id(player)))]
+            for player in db["matches"][match]["teams"].get(team, [])
+        ]
+        back = [[InlineKeyboardButton("Back", callback_data=encode_callback("bk", mid))]]
+        markup = paged_markup(("players", match, team), rows, page, "players", (mid, tid), back)
+    return markup
+
+def search_button(match, text="🔍 Search players"):
+    """Button that starts an inline player search for `match` in the current chat."""
+    return InlineKeyboardButton(text, switch_inline_query_current_chat=f"{match} ")
+
+def match_menu(match):
+    """Text and keyboard of a match's user menu."""
+    mid = match_id(match)
+    keyboard = [
+        [InlineKeyboardButton("Create Team", callback_data=encode_callback("cr", mid))],
+        [InlineKeyboardButton("Edit Team", callback_data=encode_callback("et", mid))],
+        [InlineKeyboardButton("Add Bet", callback_data=encode_callback("ba", mid))]
+    ]
+    return f"Match: {match}", InlineKeyboardMarkup(keyboard)
+
+def edit_team_view(match, current_team):
+    """Text and keyboard for editing a user's team for a match."""
+    mid = match_id(match)
+    keyboard = [
+        [InlineKeyboardButton(player, callback_data=encode_callback("rp", mid, player_id(player)))]
+        for player in current_team
+    ]
+    keyboard.append([InlineKeyboardButton("Add Players", callback_data=encode_callback("cr", mid))])
+    keyboard.append([InlineKeyboardButton("Clear Team", callback_data=encode_callback("ct", mid))])
+    keyboard.append([InlineKeyboardButton("Back", callback_data=encode_callback("bk", mid))])
+    text = (
+        f"Edit your team for {match}:\n\n"
+        f"Captain: {current_team[0] if current_team else 'N/A'}\n"
+        f"Vice-Captain: {current_team[1] if len(current_team) > 1 else 'N/A'}\n"
+        f"Players: {', '.join(current_team) if current_team else 'None'}"
+    )
+    return text, InlineKeyboardMarkup(keyboard)
+
+# === PLAYER SEARCH ===
+class PlayerIndex:
+    """Per-match prefix index of player names for the inline player search.
+
+    Each word of a name starts a key, so "Virat Kohli" is found by "vir" and by
+    "koh". The keys of a match sit in a SortedList and a search is a range scan
+    from the typed prefix. A match is indexed on its first search; after that
+    /addplayer only adds the keys of the players it brings. Built result
+    articles are kept until the match's players change, since making them
+    costs far more than the search.
+    """
+
+    def __init__(self):
+        self.matches = {}  # match -> (SortedList of (key, player), {player: team})
+        self.articles = {}  # match -> {player: InlineQueryResultArticle}
+
+    @staticmethod
+    def keys(player):
+        words = player.casefold().split()
+        return [" ".join(words[i:]) for i in range(len(words))]
+
+    def update(self, path):
+        if not path or path == ("matches",):
+            self.matches.clear()
+            self.articles.clear()
+        elif path[0] == "matches" and path[1] in self.matches and (len(path) == 2 or path[2] in ("teams", "players")):
+            self.sync(path[1])
+
+    def sync(self, match):
+        """Bring the index of `match` in line with its players."""
+        self.articles.pop(match, None)
+        info = db["matches"].get(match)
+        if info is None:
+            del self.matches[match]
+            return
+        keys, teams = self.matches[match]
+        current = dict.fromkeys(info["players"])
+        for player in [p for p in teams if p not in current]:
+            for key in self.keys(player):
+                keys.discard((key, player))
+            del teams[player]
+        for player in current:
+            if player not in teams:
+                keys.update((key, player) for key in self.keys(player))
+                teams[player] = None
+        for team, players in info["teams"].items():
+            for player in players:
+                teams[player] = team
+
+    def entry(self, match):
+        entry = self.matches.get(match)
+        if entry is None:
+            entry = self.matches[match] = (SortedList(), {})
+            self.sync(match)
+        return entry
+
+    def search(self, match, text):
+        """Players of `match` with a word starting with `text`, by name; all of them in match order if `text` is blank."""
+        keys, teams = self.entry(match)
+        prefix = " ".join(text.casefold().split())
+        if not prefix:
+            yield from teams
+            return
+        seen = set()
+        for _, player in keys.irange((prefix,), (prefix + "\U0010ffff",)):
+            if player not in seen:
+                seen.add(player)
+                yield player
+
+    def article(self, match, player):
+        """Inline result that sends /pick for `player`."""
+        articles = self.articles.setdefault(match, {})
+        result = articles.get(player)
+        if result is None:
+            result = articles[player] = InlineQueryResultArticle(
+                id=player_id(player),
+                title=player,
+                description=self.entry(match)[1].get(player) or match,
+                input_message_content=InputTextMessageContent(f"/pick {match} {player}"),
+            )
+        return result
+
+player_index = PlayerIndex()
+
 # === USER COMMANDS ===
+@timed("command")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Welcome message for users."""
     user = update.effective_user
@@ -48,6 +2368,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Use /schedule to get started, /profile to view your bets, or /help for commands."
     )
 
+@timed("command")
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display user commands."""
     help_text = (
@@ -56,6 +2377,7 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/start - Start the bot and get a welcome message.\n"
         "/schedule - View available matches and select one to create/edit a team or place a bet.\n"
         "/editteam [match_name] - Edit your team for a specific match (optional: specify match name).\n"
+        "/pick <match_name> <player> - Add a player to your team. Tap 🔍 Search players, or type @<bot> <match_name> <part of a name>, to find them.\n"
         "/addamount <match_name> <amount> - Set a bet amount for a match (e.g., /addamount LSGvsCSK 2000).\n"
         "/check - View your selected teams for all matches.\n"
         "/profile - View your teams and bet amounts.\n"
@@ -64,26 +2386,28 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(help_text)
 
+@timed("command")
 async def schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display available matches for users to select."""
-    if not db["matches"]:
+    markup = match_list_keyboard("schedule")
+    if not markup.inline_keyboard:
         await update.message.reply_text("No matches available.")
         return
-    keyboard = [[InlineKeyboardButton(m, callback_data=f"user_match_{m}")] for m in db["matches"].keys()]
-    await update.message.reply_text("Select a match:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text("Select a match:", reply_markup=markup)
 
+@timed("command")
+@user_locked
 async def addamount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Allow users to place a bet for a match."""
     user_id = str(update.effective_user.id)
     if len(context.args) < 2:
-        keyboard = [[InlineKeyboardButton(m, callback_data=f"addamount::{m}")] for m in db["matches"].keys()]
-        await update.message.reply_text("Select a match to set your bet amount:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text("Select a match to set your bet amount:", reply_markup=match_list_keyboard("addamount"))
         return
     match_name, amount = context.args[0], context.args[1]
     if match_name not in db["matches"]:
         await update.message.reply_text("Match not found.")
         return
-    if locked_matches.get(match_name, False):
+    if is_locked(match_name):
         await update.message.reply_text("❌ This match is locked. You can't place bets.")
         return
     try:
@@ -95,110 +2419,109 @@ async def addamount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Invalid amount. Please enter a number.")
         return
     db["amounts"].setdefault(user_id, {})[match_name] = amount
-    save_db()
+    save_db("amounts", user_id, match_name)
     await update.message.reply_text(
         f"Bet of {amount} points added for {match_name}. Please tag @Trainer_OFFicial in the group."
     )
 
+@timed("command")
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display user's teams and bets."""
-    user_id = str(update.effective_user.id)
-    msg = f"📋 *Your Profile* 📋\n\n"
-    
-    if user_id not in db["user_teams"] or not db["user_teams"][user_id]:
-        msg += "No teams selected yet.\n"
-    else:
-        msg += "Your Teams:\n"
-        for match, players in db["user_teams"][user_id].items():
-            msg += f"{match}:\n"
-            for i, p in enumerate(players):
-                role = " (Captain)" if i == 0 else " (Vice-Captain)" if i == 1 else ""
-                msg += f"- {p}{role}\n"
-            msg += "\n"
-    
-    if user_id not in db["amounts"] or not db["amounts"][user_id]:
-        msg += "No bets placed yet.\n"
-    else:
-        msg += "Your Bets:\n"
-        for match, amount in db["amounts"][user_id].items():
-            msg += f"{match}: {amount} points\n"
-    
-    await update.message.reply_text(msg, parse_mode="Markdown")
+    text, markup, parse_mode = render_cache.render("profile", str(update.effective_user.id))
+    await update.message.reply_text(text, reply_markup=markup, parse_mode=parse_mode)
 
+@timed("command")
 async def check(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display user's selected teams."""
     user_id = str(update.effective_user.id)
-    if user_id not in db["user_teams"]:
+    if user_id not in db["user_teams"] and not archive.entries(user_id):
         await update.message.reply_text("You haven't selected a team yet.")
         return
-    msg = "Your teams:\n\n"
-    for match, players in db["user_teams"][user_id].items():
-        msg += f"{match}:\n"
-        for i, p in enumerate(players):
-            role = " (Captain)" if i == 0 else " (Vice-Captain)" if i == 1 else ""
-            msg += f"- {p}{role}\n"
-        if user_id in db["amounts"] and match in db["amounts"][user_id]:
-            msg += f"Bet: {db['amounts'][user_id][match]} points\n"
-        msg += "\n"
-    await update.message.reply_text(msg)
+    text, markup, parse_mode = render_cache.render("check", user_id)
+    await update.message.reply_text(text, reply_markup=markup, parse_mode=parse_mode)
 
+@timed("command")
 async def rankings(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display user rankings based on points."""
-    scores = {}
-    for uid, matches in db["user_teams"].items():
-        total = 0
-        for m, players in matches.items():
-            for i, p in enumerate(players):
-                pt = db["points"].get(p, 0)
-                if i == 0:
-                    total += pt * 2  # Captain
-                elif i == 1:
-                    total += pt * 1.5  # Vice-captain
-                else:
-                    total += pt  # Normal player
-        scores[uid] = total
-    sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    top = leaderboard.top(RANKINGS_TOP)
     msg = "Rankings:\n"
-    if not sorted_scores:
+    if not top:
         msg += "No rankings available yet."
-    for i, (uid, pts) in enumerate(sorted_scores, 1):
+    for i, (uid, pts) in enumerate(top, 1):
         msg += f"{i}. User {uid} - {int(pts)} pts\n"
+    own = leaderboard.rank(str(update.effective_user.id))
+    if own and own[0] > RANKINGS_TOP:
+        msg += f"...\n{own[0]}. You - {int(own[1])} pts\n"
     await update.message.reply_text(msg)
 
+@timed("command")
 async def edit_team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Allow users to edit their team for a match."""
     user_id = str(update.effective_user.id)
     if not context.args:
-        keyboard = [[InlineKeyboardButton(m, callback_data=f"editteam::{m}")] for m in db["matches"].keys()]
-        await update.message.reply_text("Select a match to edit your team:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text("Select a match to edit your team:", reply_markup=match_list_keyboard("editteam"))
         return
     match_name = context.args[0]
     if match_name not in db["matches"]:
         await update.message.reply_text("Match not found.")
         return
-    if locked_matches.get(match_name, False):
+    if is_locked(match_name):
         await update.message.reply_text("❌ This match is locked. You can't make changes.")
         return
     current_team = db["user_teams"].get(user_id, {}).get(match_name, [])
     if not current_team:
         await update.message.reply_text("You haven't selected a team for this match.")
         return
-    keyboard = [
-        [InlineKeyboardButton(player, callback_data=f"removeplayer::{match_name}::{player}")]
-        for player in current_team
-    ]
-    keyboard.append([InlineKeyboardButton("Add Players", callback_data=f"create_{match_name}")])
-    keyboard.append([InlineKeyboardButton("Clear Team", callback_data=f"clearteam::{match_name}")])
-    keyboard.append([InlineKeyboardButton("Back", callback_data=f"back::{match_name}")])
-    await update.message.reply_text(
-        f"Edit your team for {match_name}:\n\n"
-        f"Captain: {current_team[0] if current_team else 'N/A'}\n"
-        f"Vice-Captain: {current_team[1] if len(current_team) > 1 else 'N/A'}\n"
-        f"Players: {', '.join(current_team) if current_team else 'None'}",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+    text, markup = edit_team_view(match_name, current_team)
+    await update.message.reply_text(text, reply_markup=markup)
+
+@timed("inline")
+async def search_players(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer `<match> <part of a name>` inline queries with the matching players the user can still pick."""
+    query = update.inline_query
+    match, _, text = query.query.strip().partition(" ")
+    if match not in db["matches"] or is_locked(match):
+        await query.answer([], cache_time=0, is_personal=True)
+        return
+    picked = db["user_teams"].get(str(query.from_user.id), {}).get(match, ())
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    found = itertools.islice(
+        (p for p in player_index.search(match, text) if p not in picked), offset, offset + INLINE_RESULTS + 1
+    )
+    players = list(found)
+    results = [player_index.article(match, player) for player in players[:INLINE_RESULTS]]
+    next_offset = str(offset + INLINE_RESULTS) if len(players) > INLINE_RESULTS else ""
+    await query.answer(results, cache_time=0, is_personal=True, next_offset=next_offset)
+
+@timed("command")
+@user_locked
+async def pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add one player to the user's team, as sent by choosing an inline search result."""
+    if len(context.args) < 2:
+        await update.message.reply_text("Usage: /pick <match_name> <player>")
+        return
+    match, player = context.args[0], " ".join(context.args[1:])
+    if match not in db["matches"]:
+        await update.message.reply_text("Match not found.")
+        return
+    if is_locked(match):
+        await update.message.reply_text("❌ This match is locked. You can't make changes.")
+        return
+    if player not in db["matches"][match]["players"]:
+        await update.message.reply_text("Player not found.")
+        return
+    user_id = str(update.effective_user.id)
+    user_team = db["user_teams"].setdefault(user_id, {}).setdefault(match, [])
+    if len(user_team) >= 11 or player in user_team:
+        await update.message.reply_text("Cannot add player. Team is full or player already added.")
+        return
+    user_team.append(player)
+    save_db("user_teams", user_id, match)
+    markup = InlineKeyboardMarkup([[search_button(match, "🔍 Pick another player")]]) if len(user_team) < 11 else None
+    await update.message.reply_text(f"{player} added to your team. ({len(user_team)}/11)", reply_markup=markup)
 
 # === ADMIN COMMANDS ===
+@timed("command")
 async def admhelp(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display admin commands."""
     if not is_admin(update.effective_user.id):
@@ -208,44 +2531,98 @@ async def admhelp(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Admin Commands\n\n"
         "Here are the commands available for admins:\n"
         "/admin - Open the admin panel to manage matches.\n"
-        "/addmatch <match_name> - Add a new match (e.g., /addmatch LSGvsCSK).\n"
+        "/addmatch <match_name> [start] - Add a new match, optionally with its start time (e.g., /addmatch LSGvsCSK 2025-04-19 19:30).\n"
+        "/setstart <match_name> <start|none> - Set when a match starts; it locks automatically at that time (e.g., /setstart LSGvsCSK 2025-04-19 19:30).\n"
         "/addteam <match_name> <team_name> - Add a team to a match (e.g., /addteam LSGvsCSK LSG).\n"
         "/addplayer <match_name> <team_name> <players> - Add players to a team (e.g., /addplayer LSGvsCSK LSG Player1,Player2).\n"
         "/points <player> <points> - Assign points to a player (e.g., /points Player1 100).\n"
+        "/points <match_name> followed by one 'player points' line per player (or CSV/JSON, typed or as a file captioned /points <match_name>) - Assign a whole scorecard at once.\n"
         "/lockmatch <match_name> - Lock a match to prevent team edits or bets (e.g., /lockmatch LSGvsCSK).\n"
         "/clear - Clear all data (use with caution!).\n"
         "/announcement <group_id> <message> - Send a message to a specific group (e.g., /announcement -100123456789 Match starts soon!).\n"
         "/target <user_id> <message> - Send a message to a specific user (e.g., /target 123456789 Your team is ready!).\n"
-        "/team - View all users' teams with their user IDs for verification.\n"
-        "/backup - Download the match data as a JSON file.\n\n"
+        "/broadcast <message> - Send a message to every user of the bot (e.g., /broadcast Match locks in 10 minutes!).\n"
+        "/team [match_name] - View all users' teams with their user IDs for verification, or those of an archived match.\n"
+        "/archive <match_name> - Move a locked, finished match out of memory into the archive; it stays in /profile, /check and /rankings.\n"
+        "/settle <match_name> [winner|top3|proportional] - Work out the payouts of a finished match's bet pool.\n"
+        "/stats <match_name> - Show participants, bet pool and the most picked players and captains of a match.\n"
+        "/metrics - Show handler latency, storage and Telegram API metrics (when started with METRICS=1).\n"
+        "/backup [inc] - Download a compressed backup of the match data, or with 'inc' only the changes since the last backup.\n"
+        "/restore - Load a backup: send the file with the caption /restore (or reply /restore to it). Incremental backups are applied in order on top of the backup before them. Backups include archived matches; restoring one replaces the archive.\n\n"
         "Use /help to see user commands."
     )
     await update.message.reply_text(help_text)
 
+@timed("command")
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Open the admin panel to manage matches."""
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ You are not authorized to use this command.")
         return
-    keyboard = [[InlineKeyboardButton(m, callback_data=f"admin_match_{m}")] for m in db["matches"].keys()]
-    await update.message.reply_text("Admin Panel - Matches:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text("Admin Panel - Matches:", reply_markup=match_list_keyboard("admin"))
 
+@timed("command")
+@match_locked
 async def addmatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add a new match."""
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ You are not authorized to use this command.")
         return
     if len(context.args) < 1:
-        await update.message.reply_text("Usage: /addmatch <match_name>")
+        await update.message.reply_text("Usage: /addmatch <match_name> [YYYY-MM-DD HH:MM]")
         return
     match = context.args[0]
+    start = None
+    if len(context.args) > 1:
+        try:
+            start = parse_start(" ".join(context.args[1:]))
+        except ValueError:
+            await update.message.reply_text("Invalid start time. Use YYYY-MM-DD HH:MM.")
+            return
     if match in db["matches"]:
         await update.message.reply_text("Match already exists.")
     else:
-        db["matches"][match] = {"teams": {}, "players": []}
-        save_db()
-        await update.message.reply_text(f"Match {match} added.")
+        match, = register("matches", [match])
+        db["matches"][match] = {"teams": {}, "players": [], "start": start, "locked": False}
+        save_db("matches", match)
+        schedule_lock(context.job_queue, match)
+        if start is None:
+            await update.message.reply_text(f"Match {match} added.")
+        else:
+            await update.message.reply_text(f"Match {match} added. It locks at {format_start(start)}.")
+
+@timed("command")
+@match_locked
+async def set_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set or clear the start time at which a match locks."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+    if len(context.args) < 2:
+        await update.message.reply_text("Usage: /setstart <match_name> <YYYY-MM-DD HH:MM|none>")
+        return
+    match = context.args[0]
+    if match not in db["matches"]:
+        await update.message.reply_text("Match not found.")
+        return
+    text = " ".join(context.args[1:])
+    try:
+        start = None if text.lower() == "none" else parse_start(text)
+    except ValueError:
+        await update.message.reply_text("Invalid start time. Use YYYY-MM-DD HH:MM.")
+        return
+    db["matches"][match]["start"] = start
+    save_db("matches", match, "start")
+    schedule_lock(context.job_queue, match)
+    if start is None:
+        await update.message.reply_text(f"Start time of {match} cleared; lock it with /lockmatch.")
+    elif is_locked(match):
+        await update.message.reply_text(f"Start time of {match} set to {format_start(start)}. The match is locked.")
+    else:
+        await update.message.reply_text(f"Start time of {match} set to {format_start(start)}; it locks automatically then.")
 
+@timed("command")
+@match_locked
 async def addteam(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add a team to a match."""
     if not is_admin(update.effective_user.id):
@@ -258,10 +2635,13 @@ async def addteam(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if match not in db["matches"]:
         await update.message.reply_text("Match not found.")
         return
+    team, = register("teams", [team])
     db["matches"][match]["teams"][team] = []
-    save_db()
+    save_db("matches", match, "teams", team)
     await update.message.reply_text(f"Team {team} added to {match}.")
 
+@timed("command")
+@match_locked
 async def addplayer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Add players to a team."""
     if not is_admin(update.effective_user.id):
@@ -277,41 +2657,103 @@ async def addplayer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         player_str = " ".join(context.args[2:])
         players = [p.strip().strip("(),") for p in player_str.split(",")]
-        db["matches"][match]["teams"][team].extend(players)
+        team_players = db["matches"][match]["teams"][team]
+        players = register("players", players)
+        team_players.extend(players)
         db["matches"][match]["players"].extend(players)
-        save_db()
+        save_db("matches", match)
         await update.message.reply_text(f"Players added to {team} in {match}: {', '.join(players)}")
     except Exception as e:
         logger.error(f"Failed to add players: {e}")
         await update.message.reply_text("Failed to parse players.")
 
+def parse_scorecard(text):
+    """Parse `player points` lines, CSV rows or a JSON object into {player: points}."""
+    text = text.strip()
+    if text.startswith("{"):
+        return {str(player): int(pts) for player, pts in json.loads(text).items()}
+    scores = {}
+    for n, line in enumerate(text.splitlines()):
+        line = line.strip()
+        if not line:
+            continue
+        found = SCORE_LINE.match(line)
+        if not found:
+            if n == 0 and ("," in line or "\t" in line):
+                continue  # CSV header
+            raise ValueError(f"Can't read line: {line}")
+        scores[found.group(1).strip().strip('"')] = int(found.group(2))
+    return scores
+
+async def apply_scorecard(update: Update, match: str, text: str):
+    """Validate a scorecard for a match and apply it as one batch."""
+    try:
+        scores = parse_scorecard(text)
+    except (ValueError, TypeError, AttributeError) as e:
+        await update.message.reply_text(f"Invalid scorecard: {e}")
+        return
+    if not scores:
+        await update.message.reply_text("No player points found in the scorecard.")
+        return
+    known = set(db["matches"][match]["players"])
+    unknown = [p for p in scores if p not in known]
+    if unknown:
+        await update.message.reply_text(f"Unknown players for {match}: {', '.join(unknown)}. Nothing was changed.")
+        return
+    db["points"].update(scores)
+    # One record for the whole points table so the batch is replayed, relayed and backed up all-or-nothing.
+    save_db("points")
+    await persistence.flush()
+    await update.message.reply_text(f"Points updated for {len(scores)} players in {match}.")
+
+@timed("command")
+@match_locked
 async def points(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Assign points to a player."""
+    """Assign points to a player, or to every player of a match from a scorecard."""
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ You are not authorized to use this command.")
         return
-    if len(context.args) < 2:
+    message = update.message
+    first_line, _, lines = (message.text or message.caption or "").partition("\n")
+    parts = first_line.split(None, 2)
+    if len(parts) > 1 and parts[1] in db["matches"]:
+        body = parts[2] if len(parts) > 2 else ""
+        if message.document:
+            if message.document.file_size and message.document.file_size > SCORECARD_MAX_BYTES:
+                await message.reply_text("Scorecard file is too large.")
+                return
+            file = await message.document.get_file()
+            body = bytes(await file.download_as_bytearray()).decode("utf-8-sig", errors="replace")
+        elif lines:
+            body += "\n" + lines
+        if message.document or lines or body.lstrip().startswith("{"):
+            await apply_scorecard(update, parts[1], body)
+            return
+    if not context.args or len(context.args) < 2:
         await update.message.reply_text("Usage: /points <player> <points>")
         return
     player, pts = context.args[0], context.args[1]
     try:
         pts = int(pts)
         db["points"][player] = pts
-        save_db()
+        save_db("points", player)
         await update.message.reply_text(f"{player} got {pts} points.")
     except ValueError:
         await update.message.reply_text("Points must be a number.")
 
+@timed("command")
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Clear all data."""
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ You are not authorized to use this command.")
         return
-    db.clear()
-    db.update({"matches": {}, "user_teams": {}, "points": {}, "amounts": {}})
-    save_db()
+    # Keep the assigned IDs so buttons on old messages can't resolve to new names.
+    archive.clear()
+    replace_db(dict(empty_db(), registry=db["registry"]))
     await update.message.reply_text("All data cleared.")
 
+@timed("command")
+@match_locked
 async def lock_match(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Lock a match to prevent edits or bets."""
     if not is_admin(update.effective_user.id):
@@ -324,9 +2766,11 @@ async def lock_match(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if match_name not in db["matches"]:
         await update.message.reply_text("Match not found.")
         return
-    locked_matches[match_name] = True
+    lock(match_name)
+    schedule_lock(context.job_queue, match_name)
     await update.message.reply_text(f"✅ Match '{match_name}' has been locked.")
 
+@timed("command")
 async def announcement(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message to a specific group."""
     if not is_admin(update.effective_user.id):
@@ -339,9 +2783,10 @@ async def announcement(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = " ".join(context.args[1:])
     try:
         group_id = int(group_id)
-        await context.bot.send_message(
-            chat_id=group_id,
-            text=f"📢 *Announcement*: {message}",
+        await send_with_retry(
+            context.bot,
+            group_id,
+            f"📢 *Announcement*: {message}",
             parse_mode="Markdown"
         )
         await update.message.reply_text(f"Announcement sent to group {group_id}.")
@@ -351,6 +2796,7 @@ async def announcement(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Failed to send announcement to group {group_id}: {e}")
         await update.message.reply_text(f"Failed to send announcement: {e.message}")
 
+@timed("command")
 async def target(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message to a specific user."""
     if not is_admin(update.effective_user.id):
@@ -367,9 +2813,10 @@ async def target(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if str(user_id) not in db["user_teams"] and str(user_id) not in db["amounts"]:
             await update.message.reply_text("User has not interacted with the bot.")
             return
-        await context.bot.send_message(
-            chat_id=user_id,
-            text=f"📩 *Message from Admin*: {message}",
+        await send_with_retry(
+            context.bot,
+            user_id,
+            f"📩 *Message from Admin*: {message}",
             parse_mode="Markdown"
         )
         await update.message.reply_text(f"Message sent to user {user_id}.")
@@ -379,207 +2826,686 @@ async def target(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Failed to send message to user {user_id}: {e}")
         await update.message.reply_text(f"Failed to send message: {e.message}")
 
+@timed("command")
+async def broadcast_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a message to every user who has picked a team or placed a bet."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+    if not context.args:
+        await update.message.reply_text("Usage: /broadcast <message>")
+        return
+    message = " ".join(context.args)
+    recipients = list(dict.fromkeys([*db["user_teams"], *db["amounts"]]))
+    if not recipients:
+        await update.message.reply_text("No users to message yet.")
+        return
+    status = await update.message.reply_text(f"📤 Broadcasting to {len(recipients)} users...")
+
+    async def report(stats):
+        try:
+            await status.edit_text(broadcast_summary(stats, len(recipients), done=False))
+        except TelegramError:
+            pass
+
+    async def run():
+        stats = await broadcast(
+            context.bot,
+            (int(uid) for uid in recipients),
+            f"📢 *Announcement*: {message}",
+            report=report,
+            parse_mode="Markdown"
+        )
+        await update.message.reply_text(broadcast_summary(stats, len(recipients)))
+
+    # Run in the background so other updates keep being processed meanwhile.
+    context.application.create_task(run(), update=update)
+
+@timed("command")
 async def team(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display all users' teams with user IDs for admin verification."""
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ You are not authorized to use this command.")
         return
-    
+
+    if context.args:
+        archived_id = archive.find(context.args[0])
+        if archived_id is None:
+            await update.message.reply_text("No archived match with that name.")
+            return
+        text, markup, parse_mode = render_page("archived", archived_id)
+        await update.message.reply_text(text, reply_markup=markup, parse_mode=parse_mode)
+        return
+
     if not db["user_teams"]:
         await update.message.reply_text("No users have selected teams yet.")
         return
-    
-    msg = "📋 *User Teams for Verification* 📋\n\n"
-    for user_id, matches in db["user_teams"].items():
-        msg += f"User ID: {user_id}\n"
-        for match, players in matches.items():
-            msg += f"  Match: {match}\n"
-            if not players:
-                msg += "    No players selected.\n"
-            else:
-                for i, player in enumerate(players):
-                    role = " (Captain)" if i == 0 else " (Vice-Captain)" if i == 1 else ""
-                    msg += f"    - {player}{role}\n"
-                if user_id in db["amounts"] and match in db["amounts"][user_id]:
-                    msg += f"    Bet: {db['amounts'][user_id][match]} points\n"
-            msg += "\n"
-        msg += "-" * 20 + "\n"
-    
-    await update.message.reply_text(msg, parse_mode="Markdown")
 
+    text, markup, parse_mode = render_page("team", None)
+    await update.message.reply_text(text, reply_markup=markup, parse_mode=parse_mode)
+
+@timed("command", "archive")
+@match_locked
+async def archive_match(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Move a finished match out of memory into the on-disk archive."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+    if not context.args:
+        await update.message.reply_text("Usage: /archive <match_name>")
+        return
+    match = context.args[0]
+    if match not in db["matches"]:
+        await update.message.reply_text("Match not found.")
+        return
+    if not is_locked(match):
+        await update.message.reply_text("❌ Lock the match first; its teams and bets can still change.")
+        return
+    loop = asyncio.get_running_loop()
+    for _ in range(ARCHIVE_ATTEMPTS):
+        entry = archive_entry(match)
+        try:
+            archived_id = await loop.run_in_executor(None, archive.put, match, entry)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to archive {match}: {e}")
+            await update.message.reply_text("❌ Failed to archive the match; nothing was changed.")
+            return
+        if match in db["matches"] and archive_entry(match) == entry:
+            break
+        # Points changed (or the data was cleared) while the archive was written.
+        await loop.run_in_executor(None, archive.discard, archived_id)
+        if match not in db["matches"]:
+            await update.message.reply_text("Match not found.")
+            return
+    else:
+        await update.message.reply_text("❌ The match kept changing while it was archived. Please try again.")
+        return
+    remove_archived(match, entry)
+    archive.pending.discard(archived_id)
+    schedule_lock(context.job_queue, match)
+    await persistence.flush()
+    await update.message.reply_text(
+        f"🗄 Archived {match} with the teams and bets of {len(entry['entries'])} users. "
+        f"They stay in /profile, /check and /rankings; /team {match} lists them."
+    )
+
+@timed("command")
+async def settle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Work out who wins how much of a finished match's bet pool."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+    if not context.args:
+        await update.message.reply_text(f"Usage: /settle <match_name> [{'|'.join(POOL_RULES)}]")
+        return
+    match = context.args[0]
+    rule = context.args[1].lower() if len(context.args) > 1 else SETTLE_RULE
+    if rule not in POOL_RULES:
+        await update.message.reply_text(f"Unknown pool rule. Use one of: {', '.join(POOL_RULES)}.")
+        return
+    if match in db["matches"]:
+        if not is_locked(match):
+            await update.message.reply_text("❌ Lock the match first; its teams and bets can still change.")
+            return
+        users, bets, scores = match_bettors(match)
+    else:
+        archived_id = archive.find(match)
+        if archived_id is None:
+            await update.message.reply_text("Match not found.")
+            return
+        users, bets, scores = archived_bettors(archived_id)
+    if not users:
+        await update.message.reply_text(f"No bets were placed on {match}.")
+        return
+    payouts = settle_pool(bets, scores, rule)
+    pool, paid = int(bets.sum()), int(payouts.sum())
+    winners = [i for i in np.argsort(-payouts, kind="stable") if payouts[i] > 0]
+    lines = [
+        f"💰 Settlement of {match} ({rule})\n",
+        f"Pool: {pool} points from {len(users)} bets",
+        f"Paid out: {paid} points, kept: {pool - paid} points\n",
+        "Winners:" if winners else "No winners.",
+    ]
+    lines += [
+        f"{n}. User {users[i]} - {scores[i]:g} pts, bet {int(bets[i])} → {int(payouts[i])}"
+        for n, i in enumerate(winners[:SETTLE_TOP], 1)
+    ]
+    if len(winners) > SETTLE_TOP:
+        lines.append(f"...and {len(winners) - SETTLE_TOP} more in the attached file.")
+    await update.message.reply_text("\n".join(lines))
+    if len(winners) > SETTLE_TOP:
+        csv = "user_id,bet,score,payout\n" + "".join(
+            f"{users[i]},{int(bets[i])},{scores[i]:g},{int(payouts[i])}\n" for i in np.argsort(-payouts, kind="stable")
+        )
+        await update.message.reply_document(document=csv.encode(), filename=f"settlement_{match}.csv")
+
+@timed("command")
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show pick, captain and bet statistics for a match."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+    if not context.args:
+        await update.message.reply_text("Usage: /stats <match_name>")
+        return
+    match = context.args[0]
+    if match not in db["matches"]:
+        await update.message.reply_text("Match not found.")
+        return
+    counters = match_stats.get(match)
+
+    def ranking(counter):
+        top = [(player, n) for player, n in counter.most_common(STATS_TOP) if n > 0]
+        return "\n".join(f"  {player}: {n}" for player, n in top) or "  -"
+
+    text = (
+        f"📊 Stats for {match}\n\n"
+        f"Participants: {len(counters['entries'])}\n"
+        f"Teams: {counters['teams']}\n"
+        f"Bets: {counters['bets']} (pool {counters['pool']} points)\n\n"
+        f"Top captains:\n{ranking(counters['captains'])}\n"
+        f"Top vice-captains:\n{ranking(counters['vice_captains'])}\n"
+        f"Most picked:\n{ranking(counters['picks'])}"
+    )
+    await update.message.reply_text(text)
+
+@timed("command", "metrics")
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show handler, storage and Bot API metrics."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+    if not METRICS_ENABLED:
+        await update.message.reply_text("Metrics are off. Start the bot with METRICS=1 to collect them.")
+        return
+    text = metrics.render()
+    if len(text) <= PAGE_CHARS:
+        await update.message.reply_text(text)
+    else:
+        await update.message.reply_document(document=text.encode(), filename="metrics.txt")
+
+@timed("command")
 async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Download the match data JSON file."""
+    """Send a compressed backup of the match data; `/backup inc` sends only the changes since the last one."""
     if not is_admin(update.effective_user.id):
         await update.message.reply_text("❌ You are not authorized to use this command.")
         return
-    
+    incremental = bool(context.args) and context.args[0].lower() in ("inc", "incremental")
+    note = ""
+    if incremental and backup_journal.base is None:
+        incremental = False
+        note = "\nNo backup was taken since the bot started, so this one is full."
+    document, archived = backup_document(incremental)
+    previous = backup_journal.begin(document["id"], archive.mark())
     try:
-        with open(DATA_FILE, "rb") as f:
-            await update.message.reply_document(
-                document=f,
-                filename="match_data_backup.json",
-                caption="Here is the backup of the match data."
-            )
+        path, count = await asyncio.get_running_loop().run_in_executor(None, write_backup, document, archived)
+        try:
+            with open(path, "rb") as f:
+                await update.message.reply_document(
+                    document=f,
+                    filename=f"match_data_{document['kind']}_{document['id']}.json.gz",
+                    caption=(
+                        f"Backup {document['id']}"
+                        + (f", changes since {document['base']}," if incremental else " of all match data,")
+                        + f" with {count} archived matches."
+                        + note
+                    ),
+                )
+        finally:
+            os.remove(path)
     except Exception as e:
+        backup_journal.abort(previous)
         logger.error(f"Failed to send backup: {e}")
         await update.message.reply_text("❌ Failed to generate backup. Please try again later.")
 
-# === CALLBACK HANDLER ===
-async def user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle inline button callbacks."""
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-
-    if data.startswith("admin_match_"):
-        match = data.replace("admin_match_", "")
-        keyboard = [
-            [InlineKeyboardButton("Add Team", callback_data=f"admin_addteam_{match}")],
-            [InlineKeyboardButton("Add Players", callback_data=f"admin_addplayer_{match}")]
-        ]
-        await query.edit_message_text(f"Admin Panel for {match}:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    elif data.startswith("user_match_"):
-        match = data.replace("user_match_", "")
-        keyboard = [
-            [InlineKeyboardButton("Create Team", callback_data=f"create_{match}")],
-            [InlineKeyboardButton("Edit Team", callback_data=f"editteam::{match}")],
-            [InlineKeyboardButton("Add Bet", callback_data=f"addamount::{match}")]
-        ]
-        await query.edit_message_text(f"Match: {match}", reply_markup=InlineKeyboardMarkup(keyboard))
+def restore_backup(document, job_queue):
+    """Swap in a checked backup document.
 
-    elif data.startswith("addamount::"):
-        match = data.replace("addamount::", "")
-        if match not in db["matches"]:
-            await query.edit_message_text("Match not found.")
-            return
-        if locked_matches.get(match, False):
-            await query.answer("❌ This match is locked. You can't place bets.", show_alert=True)
-            return
-        await query.edit_message_text(
-            f"Please set your bet for {match} using the command:\n"
-            f"/addamount {match} <amount>\n"
-            f"Example: /addamount {match} 2000"
+    Runs on the event loop thread with no await, so handlers see either the old
+    data or the restored data, never a mix. Backups from before archived matches
+    were included leave the archive as it is.
+    """
+    if document["kind"] == "full":
+        data = document["data"]
+        previous = dict(registries)
+        try:
+            decode_db(data)
+            if "archive" in document:
+                archive.restore(document["archive"])
+        except Exception:
+            registries.update(previous)
+            raise
+        replace_db(data)
+    else:
+        if "archive" in document:
+            archive.restore(document["archive"], document["archive_ids"])
+        for record in document["records"]:
+            if not record[1]:
+                replace_db(record[2] if record[0] == "set" else empty_db())
+                continue
+            apply_record(db, record)
+            sync_registries(tuple(record[1]))
+            save_db(*record[1])
+    for match in db["matches"]:
+        schedule_lock(job_queue, match)
+    backup_journal.reset(document["id"], archive.mark())
+
+@timed("command")
+async def restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Load a backup sent with the caption /restore (or replied to with /restore)."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+    message = update.message
+    attachment = message.document or (message.reply_to_message and message.reply_to_message.document)
+    if attachment is None:
+        await message.reply_text("Send a backup file with the caption /restore, or reply /restore to one.")
+        return
+    if attachment.file_size and attachment.file_size > RESTORE_MAX_BYTES:
+        await message.reply_text("Backup file is too large.")
+        return
+    file = await attachment.get_file()
+    blob = bytes(await file.download_as_bytearray())
+    try:
+        document = await asyncio.get_running_loop().run_in_executor(None, read_backup, blob)
+    except (ValueError, OSError, EOFError) as e:
+        await message.reply_text(f"❌ Not restored: {e}")
+        return
+    if document["kind"] == "incremental" and document["base"] != backup_journal.base:
+        await message.reply_text(
+            f"❌ Not restored: this backup holds the changes since {document['base']}, but the current data "
+            f"is at {backup_journal.base or 'no known backup'}. Restore the backups before it first."
         )
+        return
+    try:
+        restore_backup(document, context.job_queue)
+    except Exception as e:
+        logger.error(f"Failed to restore backup: {e}")
+        await message.reply_text("❌ Failed to restore the backup; the data was not changed.")
+        return
+    await persistence.flush()
+    if document["kind"] == "full":
+        text = f"✅ Restored {len(db['matches'])} matches and the teams of {len(db['user_teams'])} users."
+    else:
+        text = f"✅ Applied {len(document['records'])} changes from backup {document['id']}."
+    if "archive" in document:
+        text += f" {len(document['archive'])} archived matches restored."
+    else:
+        text += "\n⚠️ This backup predates archived matches, so the archive was left as it is."
+        both = [match for match in db["matches"] if archive.find(match) is not None]
+        if both:
+            text += (
+                f" Active again but also archived, so shown twice (archiving again adds a second "
+                f"archive entry): {', '.join(both)}."
+            )
+    await message.reply_text(text)
 
-    elif data.startswith("editteam::"):
-        match = data.replace("editteam::", "")
-        user_id = str(query.from_user.id)
-        if locked_matches.get(match, False):
-            await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
-            return
-        current_team = db["user_teams"].get(user_id, {}).get(match, [])
-        if not current_team:
-            await query.edit_message_text("You haven't selected a team for this match.")
+# === RESPONSES ===
+api_calls_saved = Counter()  # Bot API calls not made, by reason
+
+def count_saved(reason):
+    api_calls_saved[reason] += 1
+    if METRICS_ENABLED:
+        metrics.inc("bot_api_calls_saved_total", reason=reason)
+
+class ScreenCache:
+    """What the bot last put on each message it edited, to skip edits that would change nothing.
+
+    Entries are keyed by (chat, message) and hold the message's edit_date after
+    our edit with hashes of the text (and its parse mode) and of the keyboard.
+    A callback query carries the message as it is now, so an entry only counts
+    while that edit_date is unchanged. Plain-text messages with no entry are
+    compared with the query's copy of the message.
+    """
+
+    def __init__(self, size=SCREEN_CACHE_SIZE):
+        self.size = size
+        self.screens = OrderedDict()
+
+    def current(self, message):
+        """(text hash, keyboard hash) of what `message` shows, or None if unknown."""
+        if message is None:
+            return None
+        key = (message.chat_id, message.message_id)
+        screen = self.screens.get(key)
+        if screen is not None and screen[0] == message.edit_date:
+            self.screens.move_to_end(key)
+            return screen[1:]
+        if message.text is not None and not message.entities:
+            return hash((message.text, None)), hash(message.reply_markup)
+        return None
+
+    def store(self, message, edited, text_hash, markup_hash):
+        if message is None or not isinstance(edited, Message):
             return
-        keyboard = [
-            [InlineKeyboardButton(player, callback_data=f"removeplayer::{match}::{player}")]
-            for player in current_team
-        ]
-        keyboard.append([InlineKeyboardButton("Add Players", callback_data=f"create_{match}")])
-        keyboard.append([InlineKeyboardButton("Clear Team", callback_data=f"clearteam::{match}")])
-        keyboard.append([InlineKeyboardButton("Back", callback_data=f"back::{match}")])
-        await query.edit_message_text(
-            f"Edit your team for {match}:\n\n"
-            f"Captain: {current_team[0] if current_team else 'N/A'}\n"
-            f"Vice-Captain: {current_team[1] if len(current_team) > 1 else 'N/A'}\n"
-            f"Players: {', '.join(current_team) if current_team else 'None'}",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
+        key = (message.chat_id, message.message_id)
+        self.screens[key] = (edited.edit_date, text_hash, markup_hash)
+        self.screens.move_to_end(key)
+        if len(self.screens) > self.size:
+            self.screens.popitem(last=False)
+
+screens = ScreenCache()
+
+class CallbackResponse:
+    """Stands in for the CallbackQuery a callback handler replies to.
+
+    Handlers answer and edit as they would on the query. answer() only records
+    what to say; finish() sends one answer when the handler is done, with no
+    text if it never answered. Edits that would leave the message as it is are
+    skipped.
+    """
 
-    elif data.startswith("create_"):
-        match = data.replace("create_", "")
-        if locked_matches.get(match, False):
-            await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+    def __init__(self, query):
+        self.query = query
+        self.from_user = query.from_user
+        self.message = query.message
+        self.answer_kwargs = None
+
+    async def answer(self, text=None, show_alert=False):
+        # Every answer() is merged into the single one finish() sends.
+        count_saved("answer")
+        if self.answer_kwargs is None:
+            self.answer_kwargs = {"text": text, "show_alert": show_alert}
+
+    async def finish(self):
+        await self.query.answer(**(self.answer_kwargs or {}))
+
+    async def edit_message_text(self, text, reply_markup=None, parse_mode=None):
+        screen = hash((text, parse_mode)), hash(reply_markup)
+        if screens.current(self.message) == screen:
+            count_saved("edit")
             return
-        db["user_teams"].setdefault(str(query.from_user.id), {}).setdefault(match, [])
-        keyboard = []
-        for team, players in db["matches"][match]["teams"].items():
-            keyboard.append([InlineKeyboardButton(f"{team}", callback_data=f"selectteam::{match}::{team}")])
-        await query.edit_message_text("Choose team to select players:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-    elif data.startswith("selectteam::"):
-        _, match, team = data.split("::")
-        if locked_matches.get(match, False):
-            await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+        edited = await self.query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        screens.store(self.message, edited, *screen)
+
+    async def edit_message_reply_markup(self, reply_markup=None):
+        current = screens.current(self.message)
+        if current is not None and current[1] == hash(reply_markup):
+            count_saved("edit")
             return
-        players = db["matches"][match]["teams"].get(team, [])
-        if not players:
-            await query.edit_message_text(f"No players available for team {team}.")
+        edited = await self.query.edit_message_reply_markup(reply_markup=reply_markup)
+        if current is not None:
+            screens.store(self.message, edited, current[0], hash(reply_markup))
+
+async def report_savings(context: ContextTypes.DEFAULT_TYPE):
+    """Log the Bot API calls skipped since the last report."""
+    last = context.job.data
+    saved = api_calls_saved - last
+    last.update(saved)
+    if saved:
+        logger.info(
+            f"Responses: merged {saved['answer']} callback answers and skipped {saved['edit']} "
+            f"unchanged edits in the last {SAVINGS_REPORT_EVERY}s"
+        )
+
+# === CALLBACK HANDLER ===
+CALLBACKS = {}
+
+def callback(op):
+    """Register a handler for callback data with opcode `op`."""
+    def register(func):
+        CALLBACKS[op] = timed("callback", op)(func)
+        return func
+    return register
+
+async def user_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle inline button callbacks."""
+    response = CallbackResponse(update.callback_query)
+    op, _, fields = update.callback_query.data.partition(":")
+    handler = CALLBACKS.get(op)
+    try:
+        if handler is None:
+            # Buttons from before an upgrade, or the page counter button.
             return
-        keyboard = [
-            [InlineKeyboardButton(player, callback_data=f"selectplayer::{match}::{team}::{player}")]
-            for player in players
-        ]
-        keyboard.append([InlineKeyboardButton("Back", callback_data=f"back::{match}")])
-        await query.edit_message_text(f"Select players from {team}:", reply_markup=InlineKeyboardMarkup(keyboard))
+        async with locks.user(response.from_user.id):
+            await handler(response, context, *fields.split(":")) if fields else await handler(response, context)
+    finally:
+        await response.finish()
+
+async def resolve_match(query, mid):
+    """Match name for an ID from callback data, telling the user if it no longer exists."""
+    match = lookup("matches", mid)
+    if match not in db["matches"]:
+        await query.edit_message_text("Match not found.")
+        return None
+    return match
+
+@callback("pg")
+async def on_page(query, context, view, anchor, direction, owner=None):
+    admin_only = PAGED_VIEWS[view][4]
+    if admin_only and not is_admin(query.from_user.id):
+        return
+    if not admin_only:
+        owner = str(query.from_user.id)
+    text, markup, parse_mode = render_cache.render(view, owner, int(anchor), backwards=direction == "b")
+    await query.edit_message_text(text, reply_markup=markup, parse_mode=parse_mode)
 
-    elif data.startswith("selectplayer::"):
-        _, match, team, player = data.split("::")
-        if locked_matches.get(match, False):
-            await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+@callback("kb")
+async def on_keyboard_page(query, context, kind, page, mid=None, tid=None):
+    if kind in MATCH_LISTS:
+        if MATCH_LISTS[kind][1] and not is_admin(query.from_user.id):
+            return
+        markup = match_list_keyboard(kind, int(page))
+    else:
+        match = await resolve_match(query, mid)
+        if match is None:
             return
-        user_teams = db["user_teams"].setdefault(str(query.from_user.id), {}).setdefault(match, [])
-        if len(user_teams) < 11 and player not in user_teams:
-            user_teams.append(player)
-            save_db()
-            await query.edit_message_text(f"{player} added to your team. ({len(user_teams)}/11)")
+        if kind == "teams":
+            markup = teams_keyboard(match, int(page))
         else:
-            await query.answer("Cannot add player. Team is full or player already added.", show_alert=True)
+            team = lookup("teams", tid)
+            if team not in db["matches"][match]["teams"]:
+                return
+            markup = players_keyboard(match, team, int(page))
+    await query.edit_message_reply_markup(reply_markup=markup)
+
+@callback("am")
+async def on_admin_match(query, context, mid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    keyboard = [
+        [InlineKeyboardButton("Add Team", callback_data=encode_callback("at", mid))],
+        [InlineKeyboardButton("Add Players", callback_data=encode_callback("ap", mid))]
+    ]
+    await query.edit_message_text(f"Admin Panel for {match}:", reply_markup=InlineKeyboardMarkup(keyboard))
+
+@callback("at")
+async def on_admin_addteam(query, context, mid):
+    match = await resolve_match(query, mid)
+    if match is not None:
+        await query.edit_message_text(f"Add a team with:\n/addteam {match} <team_name>")
+
+@callback("ap")
+async def on_admin_addplayer(query, context, mid):
+    match = await resolve_match(query, mid)
+    if match is not None:
+        await query.edit_message_text(f"Add players with:\n/addplayer {match} <team_name> <player1,player2,...>")
+
+@callback("um")
+@callback("bk")
+async def on_match_menu(query, context, mid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    text, markup = match_menu(match)
+    await query.edit_message_text(text, reply_markup=markup)
+
+@callback("ba")
+async def on_add_amount(query, context, mid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    if is_locked(match):
+        await query.answer("❌ This match is locked. You can't place bets.", show_alert=True)
+        return
+    await query.edit_message_text(
+        f"Please set your bet for {match} using the command:\n"
+        f"/addamount {match} <amount>\n"
+        f"Example: /addamount {match} 2000"
+    )
+
+@callback("et")
+async def on_edit_team(query, context, mid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    user_id = str(query.from_user.id)
+    if is_locked(match):
+        await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+        return
+    current_team = db["user_teams"].get(user_id, {}).get(match, [])
+    if not current_team:
+        await query.edit_message_text("You haven't selected a team for this match.")
+        return
+    text, markup = edit_team_view(match, current_team)
+    await query.edit_message_text(text, reply_markup=markup)
+
+@callback("cr")
+async def on_create_team(query, context, mid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    if is_locked(match):
+        await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+        return
+    user_id = str(query.from_user.id)
+    if match not in db["user_teams"].get(user_id, {}):
+        db["user_teams"].setdefault(user_id, {})[match] = []
+        save_db("user_teams", user_id, match)
+    await query.edit_message_text("Choose team to select players:", reply_markup=teams_keyboard(match))
+
+@callback("st")
+async def on_select_team(query, context, mid, tid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    if is_locked(match):
+        await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+        return
+    team = lookup("teams", tid)
+    players = db["matches"][match]["teams"].get(team, [])
+    if not players:
+        await query.edit_message_text(f"No players available for team {team}.")
+        return
+    await query.edit_message_text(f"Select players from {team}:", reply_markup=players_keyboard(match, team))
+
+@callback("sp")
+async def on_select_player(query, context, mid, tid, pid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    if is_locked(match):
+        await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+        return
+    team, player = lookup("teams", tid), lookup("players", pid)
+    if player not in db["matches"][match]["teams"].get(team, ()):
+        await query.edit_message_text("Player not found.")
+        return
+    user_teams = db["user_teams"].setdefault(str(query.from_user.id), {}).setdefault(match, [])
+    if len(user_teams) < 11 and player not in user_teams:
+        user_teams.append(player)
+        save_db("user_teams", str(query.from_user.id), match)
+        # Keep the team's keyboard up so the next player is one tap away.
+        markup = players_keyboard(match, team) if len(user_teams) < 11 else None
+        await query.edit_message_text(f"{player} added to your team. ({len(user_teams)}/11)", reply_markup=markup)
+    else:
+        await query.answer("Cannot add player. Team is full or player already added.", show_alert=True)
 
-    elif data.startswith("removeplayer::"):
-        _, match, player = data.split("::")
-        if locked_matches.get(match, False):
-            await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+@callback("rp")
+async def on_remove_player(query, context, mid, pid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    if is_locked(match):
+        await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+        return
+    player = lookup("players", pid)
+    user_id = str(query.from_user.id)
+    user_team = db["user_teams"].get(user_id, {}).get(match, [])
+    if player in user_team:
+        user_team.remove(player)
+        save_db("user_teams", user_id, match)
+        current_team = db["user_teams"].get(user_id, {}).get(match, [])
+        if not current_team:
+            await query.edit_message_text("Your team is now empty.")
             return
-        user_id = str(query.from_user.id)
-        user_team = db["user_teams"].get(user_id, {}).get(match, [])
-        if player in user_team:
-            user_team.remove(player)
-            save_db()
-            current_team = db["user_teams"].get(user_id, {}).get(match, [])
-            if not current_team:
-                await query.edit_message_text("Your team is now empty.")
-                return
-            keyboard = [
-                [InlineKeyboardButton(p, callback_data=f"removeplayer::{match}::{p}")]
-                for p in current_team
-            ]
-            keyboard.append([InlineKeyboardButton("Add Players", callback_data=f"create_{match}")])
-            keyboard.append([InlineKeyboardButton("Clear Team", callback_data=f"clearteam::{match}")])
-            keyboard.append([InlineKeyboardButton("Back", callback_data=f"back::{match}")])
-            await query.edit_message_text(
-                f"Edit your team for {match}:\n\n"
-                f"Captain: {current_team[0] if current_team else 'N/A'}\n"
-                f"Vice-Captain: {current_team[1] if len(current_team) > 1 else 'N/A'}\n"
-                f"Players: {', '.join(current_team) if current_team else 'None'}",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+        text, markup = edit_team_view(match, current_team)
+        await query.edit_message_text(text, reply_markup=markup)
+    else:
+        await query.edit_message_text(f"{player} was not in your team.")
+
+@callback("ct")
+async def on_clear_team(query, context, mid):
+    match = await resolve_match(query, mid)
+    if match is None:
+        return
+    if is_locked(match):
+        await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
+        return
+    user_id = str(query.from_user.id)
+    db["user_teams"].get(user_id, {}).pop(match, None)
+    save_db("user_teams", user_id, match)
+    await query.edit_message_text(f"Your team for {match} has been cleared.")
+
+async def post_init(application: Application):
+    """Schedule the lock jobs of matches loaded from disk (overdue ones lock right away) and start the metrics endpoint."""
+    if shard is None or shard.index == 0:
+        for match in db["matches"]:
+            schedule_lock(application.job_queue, match)
+    application.job_queue.run_repeating(report_savings, SAVINGS_REPORT_EVERY, data=Counter())
+    if METRICS_ENABLED:
+        metrics.gauge("bot_update_queue_depth", application.update_queue.qsize)
+        metrics.gauge("bot_db_pending_paths", lambda: len(persistence.dirty))
+        metrics.gauge("bot_render_cache_hits", lambda: render_cache.hits)
+        metrics.gauge("bot_render_cache_misses", lambda: render_cache.misses)
+        metrics.gauge("bot_render_cache_pages", lambda: len(render_cache.pages))
+        if METRICS_PORT:
+            application.bot_data["metrics_server"] = await asyncio.start_server(
+                serve_metrics, METRICS_LISTEN, METRICS_PORT + (shard.index if shard else 0)
             )
-        else:
-            await query.edit_message_text(f"{player} was not in your team.")
 
-    elif data.startswith("clearteam::"):
-        match = data.replace("clearteam::", "")
-        if locked_matches.get(match, False):
-            await query.answer("❌ This match is locked. You can't make changes.", show_alert=True)
-            return
-        user_id = str(query.from_user.id)
-        db["user_teams"].get(user_id, {}).pop(match, None)
-        save_db()
-        await query.edit_message_text(f"Your team for {match} has been cleared.")
-
-    elif data.startswith("back::"):
-        match = data.replace("back::", "")
-        keyboard = [
-            [InlineKeyboardButton("Create Team", callback_data=f"create_{match}")],
-            [InlineKeyboardButton("Edit Team", callback_data=f"editteam::{match}")],
-            [InlineKeyboardButton("Add Bet", callback_data=f"addamount::{match}")]
-        ]
-        await query.edit_message_text(f"Match: {match}", reply_markup=InlineKeyboardMarkup(keyboard))
+async def shutdown(application: Application):
+    """Flush pending database changes before the bot exits."""
+    await persistence.flush()
+    stats = persistence.stats
+    logger.info(
+        f"Persistence: {stats['flushes']} flushes, {stats['mutations']} mutations coalesced into "
+        f"{stats['records']} records, max flush {stats['max_flush_ms']:.1f} ms"
+    )
+    logger.info(
+        f"Render cache: {render_cache.hits} hits, {render_cache.misses} misses, "
+        f"{len(render_cache.pages)} pages cached"
+    )
+    logger.info(
+        f"Throttle: dropped {throttle.dropped['duplicate']} duplicate taps and "
+        f"{throttle.dropped['throttled']} updates over the per-user rate"
+    )
+    logger.info(
+        f"Responses: merged {api_calls_saved['answer']} callback answers and skipped "
+        f"{api_calls_saved['edit']} unchanged edits"
+    )
 
-def main():
-    """Run the bot."""
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application(request=None):
+    """Build the Application with every handler registered; `request` replaces the Bot API HTTP client."""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .update_queue(asyncio.Queue(UPDATE_QUEUE_SIZE))
+        .post_init(post_init)
+        .post_shutdown(shutdown)
+    )
+    if request is None:
+        request = HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE)
+    if METRICS_ENABLED:
+        request = MeasuredRequest(request)
+    builder.request(request)
+    application = builder.build()
+
+    # Runs first and stops duplicate taps and floods before they reach a handler
+    application.add_handler(TypeHandler(Update, throttle_updates), group=-1)
 
     # Command Handlers
     application.add_handler(CommandHandler("start", start))
@@ -590,23 +3516,229 @@ def main():
     application.add_handler(CommandHandler("addteam", addteam))
     application.add_handler(CommandHandler("addplayer", addplayer))
     application.add_handler(CommandHandler("points", points))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/points(@\w+)?\s"), points))
     application.add_handler(CommandHandler("clear", clear))
     application.add_handler(CommandHandler("lockmatch", lock_match))
+    application.add_handler(CommandHandler("setstart", set_start))
     application.add_handler(CommandHandler("announcement", announcement))
     application.add_handler(CommandHandler("target", target))
+    application.add_handler(CommandHandler("broadcast", broadcast_all))
     application.add_handler(CommandHandler("rankings", rankings))
     application.add_handler(CommandHandler("check", check))
     application.add_handler(CommandHandler("editteam", edit_team))
     application.add_handler(CommandHandler("addamount", addamount))
+    application.add_handler(CommandHandler("pick", pick))
     application.add_handler(CommandHandler("profile", profile))
     application.add_handler(CommandHandler("team", team))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("archive", archive_match))
+    application.add_handler(CommandHandler("settle", settle))
+    application.add_handler(CommandHandler("metrics", show_metrics))
     application.add_handler(CommandHandler("backup", backup))
+    application.add_handler(CommandHandler("restore", restore))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/restore(@\w+)?(\s|$)"), restore))
 
     # Callback Handler
     application.add_handler(CallbackQueryHandler(user_callback))
 
-    # Run the bot
-    application.run_polling()
+    # Inline player search; needs inline mode switched on for the bot with @BotFather
+    application.add_handler(InlineQueryHandler(search_players))
+    return application
+
+# === SHARDING ===
+# With SHARDS > 1 the main process only receives updates and routes them to
+# SHARDS worker processes by user ID. Every worker keeps a full copy of the
+# database in memory and they all share one SQLite file. Each key has a single
+# writer: a user's teams and bets belong to that user's worker, and match-wide
+# data (matches, points, locks, the registry, /clear) to worker 0, which gets
+# every admin's updates. Workers persist their own changes and publish them
+# through the main process, which forwards them to the other workers in one
+# order, so every copy goes through the same sequence of admin changes. /clear
+# and a restore replace the whole database on worker 0, which saves everything
+# but the other workers' users; each worker saves and republishes its own users
+# when the replacement reaches it (replace_db(), save_own_users()).
+
+class ShardLink:
+    """A worker's connection to the main process."""
+
+    def __init__(self, index, outbox):
+        self.index = index
+        self.outbox = outbox
+
+    def publish(self, *paths):
+        # Queue.put pickles later on a feeder thread, so send a copy.
+        self.outbox.put((self.index, [replica_record(path) for path in paths]))
+
+USER_KEYS = ("user_teams", "amounts")  # top-level keys whose entries belong to the user's worker
+
+def user_shard(user_id):
+    """Index of the worker that writes the teams and bets of `user_id` (a db key)."""
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return 0
+    return 0 if is_admin(user_id) else user_id % SHARDS
+
+def own_users():
+    """Paths of the users' teams and bets this worker writes; all of them outside a shard worker."""
+    return {
+        (key, uid) for key in USER_KEYS for uid in db.get(key, ())
+        if shard is None or user_shard(uid) == shard.index
+    }
+
+def save_own_users(before):
+    """Persist and publish this worker's users after the whole database was replaced.
+
+    `before` is own_users() from before the replacement. Publishing them puts
+    their final state after any of their changes that crossed the replacement
+    on its way, so every copy ends up the same.
+    """
+    paths = sorted(before | own_users())
+    for path in paths:
+        persistence.mark(path)
+    if paths:
+        shard.publish(*paths)
+
+def replica_record(path):
+    """Record carrying the current in-memory value at `path` to another worker."""
+    node = db
+    for key in path:
+        node = node.get(key) if isinstance(node, dict) else None
+        if node is None:
+            return ["del", list(path)]
+    return ["set", list(path), freeze(node)]
+
+def apply_replicated(records):
+    """Apply changes published by another worker; that worker has already persisted them."""
+    for record in records:
+        path = tuple(record[1])
+        users = own_users() if not path else None
+        apply_record(db, record)
+        sync_registries(path)
+        refresh_indexes(path)
+        if users is not None:
+            # /clear or /restore on worker 0, which leaves this worker's users to it.
+            save_own_users(users)
+
+def shard_of(update):
+    """Index of the worker that handles `update`: admins all go to worker 0, users are spread by ID."""
+    user = update.effective_user
+    if user is None or is_admin(user.id):
+        return 0
+    return user.id % SHARDS
+
+def relay(outbox, inboxes):
+    """Forward the changes each worker publishes to every other worker."""
+    while True:
+        item = outbox.get()
+        if item is None:
+            return
+        origin, records = item
+        for index, inbox in enumerate(inboxes):
+            if index != origin:
+                inbox.put(("records", records))
+
+def shard_worker(index, inbox, outbox, ready):
+    """Entry point of worker process `index`."""
+    global shard
+    # The main process stops the workers once it has stopped taking updates.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    shard = ShardLink(index, outbox)
+    asyncio.run(serve_shard(inbox, ready))
+    persistence.close()
+    store.close(snapshot_db())
+
+async def serve_shard(inbox, ready):
+    """Process routed updates and replicated changes until the main process sends None."""
+    application = build_application()
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, ready.wait)
+    while True:
+        item = await loop.run_in_executor(None, inbox.get)
+        if item is None:
+            break
+        kind, payload = item
+        if kind == "update":
+            await application.update_queue.put(Update.de_json(payload, application.bot))
+        else:
+            apply_replicated(payload)
+    await application.stop()
+    await shutdown(application)
+    await application.shutdown()
+
+def run_sharded():
+    """Receive updates in this process and hand them to SHARDS worker processes."""
+    if STORAGE_BACKEND != "sqlite":
+        raise SystemExit("SHARDS > 1 needs STORAGE_BACKEND=sqlite so the workers can share the data.")
+    context = multiprocessing.get_context("spawn")
+    outbox = context.Queue()
+    inboxes = [context.Queue() for _ in range(SHARDS)]
+    ready = context.Barrier(SHARDS + 1)
+    workers = [
+        context.Process(target=shard_worker, args=(index, inbox, outbox, ready), name=f"shard-{index}")
+        for index, inbox in enumerate(inboxes)
+    ]
+    for worker in workers:
+        worker.start()
+    # Take no updates until every worker has loaded the data and started.
+    ready.wait()
+    relayer = threading.Thread(target=relay, args=(outbox, inboxes), name="shard-relay", daemon=True)
+    relayer.start()
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        inboxes[shard_of(update)].put(("update", update.to_dict()))
+
+    router = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        .update_queue(asyncio.Queue(UPDATE_QUEUE_SIZE))
+        .build()
+    )
+    router.add_handler(TypeHandler(Update, route))
+    run_application(router)
+    for inbox in inboxes:
+        inbox.put(None)
+    for worker in workers:
+        worker.join(SHARD_STOP_TIMEOUT)
+        if worker.is_alive():
+            logger.warning(f"{worker.name} did not stop in time, terminating it")
+            worker.terminate()
+    outbox.put(None)
+    relayer.join()
+    for inbox in inboxes:
+        # Changes relayed to workers that have already exited are persisted by their origin.
+        inbox.cancel_join_thread()
+
+def run_application(application):
+    """Run `application` until stopped, polling or behind a webhook as BOT_MODE says."""
+    if BOT_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        application.run_polling()
+
+def main():
+    """Run the bot."""
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        # Checked before any worker starts; setWebhook would only fail with an unclear Bot API error.
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL, the public base URL Telegram delivers updates to.")
+    if SHARDS > 1:
+        run_sharded()
+        return
+    run_application(build_application())
+    persistence.close()
+    store.close(snapshot_db())
 
 if __name__ == "__main__":
     main()
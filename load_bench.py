@@ -0,0 +1,249 @@
+"""Replay a synthetic match-day load through every handler of the bot, in process.
+
+Builds the real Application from code.py with a stub Bot API client, so no
+network is used, and feeds it Update objects made from synthetic JSON. Each
+user runs /schedule -> match menu -> create team -> (select team -> select
+player) x 11 -> /addamount, optionally followed by /rankings and /profile,
+while an admin posts /points scorecards in bursts. Reports per-step and
+overall latency, throughput, save_db() time, flush time and peak RSS.
+
+    python load_bench.py --users 10000 --concurrency 500
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+class StubRequest(BaseRequest):
+    """Bot API client that answers every call locally after `latency` seconds."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = defaultdict(int)
+        self.message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[api_method] += 1
+        # Always yield, like a real network call, so concurrent handlers interleave.
+        await asyncio.sleep(self.latency)
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif api_method in ("sendMessage", "editMessageText", "editMessageReplyMarkup", "sendDocument"):
+            self.message_id += 1
+            result = {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 1)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+def load_bot(path):
+    # code.py would shadow the standard library's `code` module, so load it by path.
+    spec = importlib.util.spec_from_file_location("bot", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000
+
+class Bench:
+    def __init__(self, bot, application, args):
+        self.bot = bot
+        self.application = application
+        self.args = args
+        self.update_id = 0
+        self.latencies = defaultdict(list)
+        self.errors = 0
+
+    async def process(self, kind, payload):
+        self.update_id += 1
+        payload["update_id"] = self.update_id
+        update = Update.de_json(payload, self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies[kind].append(time.perf_counter() - started)
+
+    def message(self, user_id, text):
+        return {
+            "message_id": self.update_id + 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        }
+
+    async def command(self, user_id, text):
+        await self.process(text.split()[0], {"message": self.message(user_id, text)})
+
+    async def tap(self, user_id, op, *fields):
+        query = {
+            "id": str(self.update_id + 1),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "chat_instance": str(user_id),
+            "message": self.message(user_id, "/schedule"),
+            "data": self.bot.encode_callback(op, *fields),
+        }
+        await self.process(op, {"callback_query": query})
+
+    async def setup(self):
+        admin = self.bot.ADMIN_IDS[0]
+        self.matches = {}
+        for m in range(self.args.matches):
+            match = f"Match{m}"
+            teams = {f"M{m}T{t}": [f"M{m}T{t}P{p}" for p in range(11)] for t in range(2)}
+            await self.command(admin, f"/addmatch {match}")
+            for team, players in teams.items():
+                await self.command(admin, f"/addteam {match} {team}")
+                await self.command(admin, f"/addplayer {match} {team} {','.join(players)}")
+            self.matches[match] = teams
+
+    async def user_session(self, user_id, rng):
+        bot = self.bot
+        match = rng.choice(list(self.matches))
+        teams = self.matches[match]
+        mid = bot.match_id(match)
+        await self.command(user_id, "/schedule")
+        await self.tap(user_id, "um", mid)
+        await self.tap(user_id, "cr", mid)
+        picks = rng.sample([(team, player) for team, players in teams.items() for player in players], 11)
+        for team, player in picks:
+            tid = bot.team_id(team)
+            await self.tap(user_id, "st", mid, tid)
+            await self.tap(user_id, "sp", mid, tid, bot.player_id(player))
+        await self.command(user_id, f"/addamount {match} {rng.randint(1, 50) * 100}")
+        if rng.random() < self.args.rankings_share:
+            await self.command(user_id, "/rankings")
+            await self.command(user_id, "/profile")
+
+    async def points_bursts(self, rng, done):
+        admin = self.bot.ADMIN_IDS[0]
+        while not done.is_set():
+            match = rng.choice(list(self.matches))
+            lines = [f"{player} {rng.randint(-5, 120)}" for players in self.matches[match].values() for player in players]
+            await self.command(admin, f"/points {match}\n" + "\n".join(lines))
+            for _ in range(self.args.points_burst):
+                player = rng.choice([p for players in self.matches[match].values() for p in players])
+                await self.command(admin, f"/points {player} {rng.randint(0, 150)}")
+            try:
+                await asyncio.wait_for(done.wait(), self.args.points_every)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        args = self.args
+        rng = random.Random(args.seed)
+        await self.setup()
+        setup_counts = {kind: len(values) for kind, values in self.latencies.items()}
+        self.latencies.clear()
+
+        save_times = []
+        save_db = self.bot.save_db
+
+        def timed_save_db(*path):
+            started = time.perf_counter()
+            save_db(*path)
+            save_times.append(time.perf_counter() - started)
+
+        self.bot.save_db = timed_save_db
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def session(user_id):
+            async with semaphore:
+                await self.user_session(user_id, random.Random(rng.random()))
+
+        done = asyncio.Event()
+        started = time.perf_counter()
+        admin = asyncio.create_task(self.points_bursts(random.Random(args.seed + 1), done))
+        await asyncio.gather(*(session(100_000 + u) for u in range(args.users)))
+        done.set()
+        await admin
+        elapsed = time.perf_counter() - started
+        await self.bot.persistence.flush()
+        self.bot.save_db = save_db
+        return setup_counts, save_times, elapsed
+
+    def report(self, setup_counts, save_times, elapsed, request):
+        everything = sorted(t for values in self.latencies.values() for t in values)
+        print(f"setup:       {sum(setup_counts.values())} admin updates")
+        print(f"load:        {self.args.users} users, {len(everything)} updates in {elapsed:.2f}s "
+              f"({len(everything) / elapsed:.0f} updates/s), {self.errors} handler errors")
+        print(f"{'step':<12}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for kind, values in sorted(self.latencies.items(), key=lambda item: -len(item[1])) + [("all", everything)]:
+            values = sorted(values)
+            print(f"{kind:<12}{len(values):>8}{percentile(values, 0.5):>10.2f}{percentile(values, 0.99):>10.2f}"
+                  f"{values[-1] * 1000:>10.2f}")
+        if save_times:
+            save_times.sort()
+            print(f"save_db():   {len(save_times)} calls, mean {statistics.mean(save_times) * 1e6:.1f} us, "
+                  f"p99 {percentile(save_times, 0.99):.3f} ms, max {save_times[-1] * 1000:.3f} ms")
+        stats = self.bot.persistence.stats
+        print(f"flushes:     {stats['flushes']} writing {stats['records']} records for {stats['mutations']} "
+              f"mutations, total {stats['total_flush_ms']:.0f} ms, max {stats['max_flush_ms']:.1f} ms")
+        print(f"peak RSS:    {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+        print(f"api calls:   {dict(request.calls)}")
+        print(f"dropped:     {dict(self.bot.throttle.dropped)} by the per-user throttle")
+        print(f"saved:       {dict(self.bot.api_calls_saved)} Bot API calls merged or skipped")
+
+async def main(args):
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="load-bench-"))
+    if not args.throttle:
+        # Sessions tap back to back, far faster than a person, so the per-user throttle would drop most of them.
+        os.environ["DUPLICATE_TAP_WINDOW"] = os.environ["USER_RATE"] = "0"
+    bot = load_bot(bot_path)
+    request = StubRequest(args.api_latency / 1000)
+    application = bot.build_application(request=request)
+    bench = Bench(bot, application, args)
+
+    async def count_error(update, context):
+        bench.errors += 1
+        if bench.errors <= 5:
+            print(f"handler error: {context.error!r}")
+
+    application.add_error_handler(count_error)
+    await application.initialize()
+    try:
+        results = await bench.run()
+    finally:
+        await application.shutdown()
+    bench.report(*results, request)
+    bot.persistence.close()
+    bot.store.close(bot.snapshot_db())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=2000, help="users building a team")
+    parser.add_argument("--matches", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=200, help="user sessions in flight at once")
+    parser.add_argument("--rankings-share", type=float, default=0.3, help="share of users who also check /rankings and /profile")
+    parser.add_argument("--points-every", type=float, default=0.5, help="seconds between admin /points bursts")
+    parser.add_argument("--points-burst", type=int, default=10, help="single-player /points updates per burst")
+    parser.add_argument("--api-latency", type=float, default=0, help="milliseconds each stubbed Bot API call takes")
+    parser.add_argument("--throttle", action="store_true", help="keep the per-user throttle on (it drops most replayed taps)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="directory for the data files (default: a new temporary directory)")
+    asyncio.run(main(parser.parse_args()))
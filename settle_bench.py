@@ -0,0 +1,80 @@
+"""Time /settle's scoring and payout computation on one synthetic match.
+
+Loads code.py in a scratch directory and fills a match with --entries users,
+each with an 11-player team from 22 players and a bet. Then it times
+match_bettors() (the role-weight matrix times the points vector) and
+settle_pool() under every pool rule. It checks the scores against the
+leaderboard's per-team scores and compares them with a plain Python loop.
+
+    python settle_bench.py --entries 100000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from load_bench import load_bot
+
+def python_scores(bot, match, users):
+    """Reference: the same scores with nested Python loops."""
+    scores = []
+    for uid in users:
+        total = 0
+        for i, player in enumerate(bot.db["user_teams"].get(uid, {}).get(match, ())):
+            weight = bot.ROLE_WEIGHTS[i] if i < len(bot.ROLE_WEIGHTS) else bot.PLAYER_WEIGHT
+            total += bot.db["points"].get(player, 0) * weight / 2
+        scores.append(total)
+    return scores
+
+def best_of(repeat, func, *args):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - started)
+    return result, min(times) * 1000
+
+def fill(bot, args):
+    """Put the synthetic match straight into the database, as if loaded from disk."""
+    rng = random.Random(args.seed)
+    players = [f"P{i}" for i in range(22)]
+    db = bot.db
+    db["matches"]["Bench"] = {"teams": {"A": players[:11], "B": players[11:]}, "players": players, "start": None, "locked": True}
+    for player in players:
+        db["points"][player] = rng.randint(-5, 120)
+    for uid in range(args.entries):
+        uid = str(100_000 + uid)
+        db["user_teams"][uid] = {"Bench": rng.sample(players, 11)}
+        if rng.random() < args.bet_share:
+            db["amounts"][uid] = {"Bench": rng.randint(1, 50) * 100}
+    bot.leaderboard.rebuild(db)
+
+def main(args):
+    bot_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="settle-bench-"))
+    bot = load_bot(bot_path)
+    fill(bot, args)
+
+    (users, bets, scores), build_ms = best_of(args.repeat, bot.match_bettors, "Bench")
+    reference, loop_ms = best_of(args.repeat, python_scores, bot, "Bench", users)
+    mismatches = sum(abs(a - b) > 1e-9 for a, b in zip(scores, reference))
+    mismatches += sum(scores[i] * 2 != bot.leaderboard.team_score(uid, "Bench") for i, uid in enumerate(users))
+    print(f"entries:     {args.entries} teams, {len(users)} bets, pool {int(bets.sum())}")
+    print(f"scores:      {build_ms:.1f} ms as a matrix product, {loop_ms:.1f} ms as Python loops, "
+          f"{mismatches} mismatches")
+    for rule in bot.POOL_RULES:
+        payouts, settle_ms = best_of(args.repeat, bot.settle_pool, bets, scores, rule)
+        print(f"{rule + ':':<13}{settle_ms:.1f} ms payouts, {int((payouts > 0).sum())} winners, "
+              f"{int(payouts.sum())} paid, total with scoring {build_ms + settle_ms:.1f} ms")
+    bot.persistence.close()
+    bot.store.close(bot.snapshot_db())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--entries", type=int, default=100_000, help="users with a team for the match")
+    parser.add_argument("--bet-share", type=float, default=0.8, help="share of those users who also bet")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement; the best is reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="directory for the data files (default: a new temporary directory)")
+    main(parser.parse_args())
@@ -0,0 +1,20 @@
+import importlib.util
+import os
+
+import pytest
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "code.py")
+
+@pytest.fixture(scope="session")
+def bot(tmp_path_factory):
+    # Importing code.py opens the data files in the working directory, so do it in a scratch one.
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("bot"))
+    try:
+        # code.py would shadow the standard library's `code` module, so load it by path.
+        spec = importlib.util.spec_from_file_location("bot", BOT_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
@@ -0,0 +1,50 @@
+def test_whole_database_record_is_a_copy(bot):
+    bot.db["matches"]["M1"] = {"teams": {"A": ["a"]}, "players": ["a"], "start": None, "locked": False}
+    bot.db["amounts"]["1"] = {"M1": 100}
+    try:
+        record = bot.resolve_record(())
+        # Changes made while the flush thread serializes the record must not reach it.
+        bot.db["amounts"]["2"] = {"M1": 200}
+        bot.db["amounts"]["1"]["M2"] = 300
+        bot.db["matches"]["M1"]["players"].append("b")
+        assert record[2]["amounts"] == {"1": {"M1": 100}}
+        assert record[2]["matches"]["M1"]["players"] == ["a"]
+    finally:
+        bot.db.clear()
+        bot.db.update(bot.empty_db())
+
+class FlakyStore:
+    """Store whose first append fails."""
+
+    def __init__(self):
+        self.batches = []
+        self.failures = 1
+
+    def append(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("database is locked")
+        self.batches.append(records)
+
+    def needs_compaction(self):
+        return False
+
+def test_failed_flush_is_retried(bot):
+    store = FlakyStore()
+    scheduler = bot.PersistenceScheduler(store)
+    bot.db["points"]["a"] = 1
+
+    async def run():
+        scheduler.mark(("points", "a"))
+        await scheduler.flush()
+        assert ("points", "a") in scheduler.dirty
+        bot.db["points"]["a"] = 2
+        await scheduler.flush()
+
+    try:
+        bot.asyncio.run(run())
+        assert store.batches == [[["set", ["points", "a"], 2]]]
+        assert not scheduler.dirty
+    finally:
+        scheduler._executor.shutdown()
+        bot.db["points"].clear()
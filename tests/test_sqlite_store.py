@@ -0,0 +1,44 @@
+RECORDS = [
+    ["set", ["matches", "M1"], {"teams": {"A": ["a1", "a2"], "B": ["b1"]}, "players": ["a1", "a2", "b1"],
+                                "start": None, "locked": False}],
+    ["set", ["matches", "M2"], {"teams": {}, "players": [], "start": 1700000000.0, "locked": False}],
+    ["set", ["matches", "M2", "teams", "C"], ["c1"]],
+    ["set", ["matches", "M2", "players"], ["c1"]],
+    ["set", ["matches", "M1", "locked"], True],
+    ["set", ["user_teams", "2"], {"M1": ["a1", "b1"]}],
+    ["set", ["user_teams", "1", "M1"], ["a2", "a1"]],
+    ["set", ["user_teams", "1", "M2"], ["c1"]],
+    ["set", ["user_teams", "3"], {}],
+    ["set", ["points", "a1"], 10],
+    ["set", ["points", "b1"], 4],
+    ["set", ["points", "a1"], 12],
+    ["set", ["amounts", "2"], {"M1": 50}],
+    ["set", ["amounts", "1", "M1"], 100],
+    ["set", ["amounts", "1", "M2"], 20],
+    ["del", ["amounts", "1", "M2"]],
+    ["set", ["registry"], {"players": ["a1", "a2", "b1", "c1"], "teams": ["A", "B", "C"]}],
+    ["set", ["archived_scores"], {"1": 30}],
+    ["set", ["archived_scores", "2"], 8],
+    ["del", ["user_teams", "3"]],
+    ["del", ["matches", "M2", "teams", "C"]],
+]
+
+def test_appended_records_load_back_unchanged(bot, tmp_path):
+    expected = bot.empty_db()
+    store = bot.SqliteStore(str(tmp_path / "data.sqlite3"))
+    store.load()
+    for i in range(0, len(RECORDS), 4):
+        batch = RECORDS[i:i + 4]
+        store.append(batch)
+        for record in batch:
+            bot.apply_record(expected, record)
+    store.conn.close()
+
+    store = bot.SqliteStore(str(tmp_path / "data.sqlite3"))
+    data = store.load()
+    store.conn.close()
+    assert data == expected
+    # Rankings break ties by insertion order, so that has to survive too.
+    assert list(data["user_teams"]) == list(expected["user_teams"])
+    assert list(data["amounts"]) == list(expected["amounts"])
+    assert list(data["points"]) == list(expected["points"])
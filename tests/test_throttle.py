@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import pytest
+
+class Query:
+    def __init__(self, user, data):
+        self.from_user = user
+        self.data = data
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append(text)
+
+def tap(user, data):
+    query = Query(user, data)
+    return SimpleNamespace(effective_user=user, callback_query=query, message=None), query
+
+def test_dropped_taps_are_answered(bot, monkeypatch):
+    monkeypatch.setattr(bot, "throttle", bot.UpdateThrottle(window=60, rate=0.001, burst=2))
+    user = SimpleNamespace(id=1)
+
+    async def run():
+        update, first = tap(user, "profile")
+        await bot.throttle_updates(update, None)
+        assert first.answers == []  # let through; the handler answers it
+
+        update, repeat = tap(user, "profile")
+        with pytest.raises(bot.ApplicationHandlerStop):
+            await bot.throttle_updates(update, None)
+        assert repeat.answers == [None]
+
+        update, second = tap(user, "rankings")
+        await bot.throttle_updates(update, None)
+        update, over = tap(user, "check")
+        with pytest.raises(bot.ApplicationHandlerStop):
+            await bot.throttle_updates(update, None)
+        assert len(over.answers) == 1 and over.answers[0]
+
+    bot.asyncio.run(run())
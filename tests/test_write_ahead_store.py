@@ -0,0 +1,63 @@
+import os
+
+def open_store(bot, tmp_path):
+    store = bot.WriteAheadStore(
+        str(tmp_path / "data.json"), str(tmp_path / "data.wal"), encode=bot.encode_db, decode=bot.decode_db
+    )
+    return store, store.load()
+
+def test_records_after_a_torn_tail_survive_restarts(bot, tmp_path):
+    store, data = open_store(bot, tmp_path)
+    store.append([["set", ["points", "A"], 1], ["set", ["points", "B"], 2]])
+    store._log.close()
+    with open(tmp_path / "data.wal", "a", encoding="utf-8") as f:
+        f.write('["set",["points","C"]')  # crash in the middle of an append
+
+    store, data = open_store(bot, tmp_path)
+    assert data["points"] == {"A": 1, "B": 2}
+    store.append([["set", ["points", "D"], 4]])
+    store._log.close()
+
+    store, data = open_store(bot, tmp_path)
+    assert data["points"] == {"A": 1, "B": 2, "D": 4}
+    store._log.close()
+
+def test_complete_log_is_left_alone(bot, tmp_path):
+    store, data = open_store(bot, tmp_path)
+    store.append([["set", ["points", "A"], 1]])
+    store._log.close()
+    size = os.path.getsize(tmp_path / "data.wal")
+
+    store, data = open_store(bot, tmp_path)
+    assert data["points"] == {"A": 1}
+    assert os.path.getsize(tmp_path / "data.wal") == size
+    store._log.close()
+
+class TornLog:
+    """Log file that writes only the first half of what it is given, then fails."""
+
+    def __init__(self, log):
+        self.log = log
+
+    def write(self, data):
+        self.log.write(data[:len(data) // 2])
+        self.log.flush()
+        raise OSError("No space left on device")
+
+    def close(self):
+        self.log.close()
+
+def test_failed_append_leaves_no_partial_record(bot, tmp_path):
+    store, data = open_store(bot, tmp_path)
+    store.append([["set", ["points", "A"], 1]])
+    store._log = TornLog(store._log)
+    try:
+        store.append([["set", ["points", "B"], 2], ["set", ["points", "C"], 3]])
+    except OSError:
+        pass
+    store.append([["set", ["points", "D"], 4]])
+    store._log.close()
+
+    store, data = open_store(bot, tmp_path)
+    assert data["points"] == {"A": 1, "D": 4}
+    store._log.close()
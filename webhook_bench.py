@@ -0,0 +1,184 @@
+"""Measure end-to-end handler latency of the bot in webhook mode without reaching Telegram.
+
+Starts code.py in webhook mode in a scratch directory, with BOT_API_URL pointing
+at a stub Bot API served from this process. Synthetic updates are POSTed to the
+webhook; an update counts as handled when the stub receives the bot's reply to
+that chat, so latencies cover the webhook server, the update queue, the handler
+and the outgoing API call.
+
+    python webhook_bench.py --updates 2000 --concurrency 50 --command /start
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import httpx
+
+TOKEN = "123456:bench"
+SECRET = "bench-secret"
+USER_BASE = 10_000_000  # synthetic user IDs, one per update
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class StubApi(ThreadingHTTPServer):
+    """Minimal Bot API: answers every method and reports replies by chat ID."""
+
+    daemon_threads = True
+
+    def __init__(self, port, on_reply):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.on_reply = on_reply
+        self.calls = {}
+        self.webhook_set = threading.Event()
+        self.message_id = 0
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        method = self.path.rsplit("/", 1)[-1]
+        server = self.server
+        server.calls[method] = server.calls.get(method, 0) + 1
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            server.message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            result = {
+                "message_id": server.message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+            server.on_reply(chat_id)
+        else:
+            result = True
+            if method == "setWebhook":
+                server.webhook_set.set()
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def synthetic_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+async def run(args):
+    loop = asyncio.get_running_loop()
+    pending = {}
+
+    def on_reply(chat_id):
+        future = pending.get(chat_id)
+        if future is not None:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(time.perf_counter()))
+
+    api_port, hook_port = free_port(), free_port()
+    api = StubApi(api_port, on_reply)
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix="webhook-bench-")
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        BOT_API_URL=f"http://127.0.0.1:{api_port}/bot",
+        BOT_MODE="webhook",
+        WEBHOOK_URL=f"http://127.0.0.1:{hook_port}",
+        WEBHOOK_SECRET=SECRET,
+        WEBHOOK_LISTEN="127.0.0.1",
+        PORT=str(hook_port),
+    )
+    bot = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")],
+        cwd=workdir, env=env, stderr=None if args.verbose else subprocess.DEVNULL,
+    )
+    try:
+        if not await loop.run_in_executor(None, api.webhook_set.wait, 30):
+            raise SystemExit("bot did not register its webhook within 30s")
+        url = f"http://127.0.0.1:{hook_port}/telegram"
+        headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+            # The webhook server starts listening just after setWebhook returns.
+            for _ in range(100):
+                try:
+                    await client.post(url, headers=headers, json={"update_id": 0})
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            semaphore = asyncio.Semaphore(args.concurrency)
+            latencies, failures = [], 0
+
+            async def send(i):
+                nonlocal failures
+                user_id = USER_BASE + i
+                future = pending[user_id] = loop.create_future()
+                async with semaphore:
+                    started = time.perf_counter()
+                    try:
+                        response = await client.post(url, headers=headers, json=synthetic_update(i + 1, user_id, args.command))
+                        response.raise_for_status()
+                        latencies.append(await asyncio.wait_for(future, args.timeout) - started)
+                    except (httpx.HTTPError, asyncio.TimeoutError):
+                        failures += 1
+                    finally:
+                        del pending[user_id]
+
+            started = time.perf_counter()
+            await asyncio.gather(*(send(i) for i in range(args.updates)))
+            elapsed = time.perf_counter() - started
+    finally:
+        bot.terminate()
+        bot.wait(30)
+        api.shutdown()
+
+    latencies.sort()
+    ms = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(f"updates:     {args.updates} ({failures} failed) at concurrency {args.concurrency}")
+    print(f"elapsed:     {elapsed:.2f}s, {len(latencies) / elapsed:.0f} updates/s")
+    if latencies:
+        print(f"latency ms:  mean {statistics.mean(latencies) * 1000:.1f}  p50 {ms(0.5):.1f}  "
+              f"p90 {ms(0.9):.1f}  p99 {ms(0.99):.1f}  max {latencies[-1] * 1000:.1f}")
+    print(f"api calls:   {api.calls}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--updates", type=int, default=1000, help="synthetic updates to send")
+    parser.add_argument("--concurrency", type=int, default=50, help="updates in flight at once")
+    parser.add_argument("--command", default="/start", help="message text of every update")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each reply")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's log output")
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()